@@ -1,6 +1,28 @@
+from datetime import timedelta
+
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connections, router, transaction
 from django.db.models.base import ModelBase, Model
+from django.db.models.fields import AutoField, BigIntegerField, IntegerField, PositiveSmallIntegerField
+from django.db.models.manager import BaseManager
 from django.db.migrations.state import ModelState
-from django.utils import six
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+
+from .cache import invalidate
+from .operations import deconstruct_q
+from .query import CombinedManager
+from .sqlfuncs import (DISCRIMINATOR, DONOR_PK, refresh_sql, refresh_comment_sql, selection_plan, view_fields,
+                       REFRESH_COMMENT_PREFIX, LAST_REFRESH_SQL)
+
+# Optional Combiner attributes, and their defaults
+COMBINER_OPTIONS = {
+    'union_all': True,
+    'materialized': False,
+    'indexes': (),
+    'incremental': False,
+    'filters': {},
+}
 
 
 class Rename:
@@ -11,9 +33,12 @@ class Rename:
         for model in reduce_this:
             models_with_renames.add(model)
         self._by_model = { model: {} for model in models_with_renames }
+        self._new_names = {} # {(model, old field name or attname): newname}, so lookups need no get_field
         for newname, submapping in kwargs.items():
             for model, oldname in submapping.items():
-                self._by_model[model][model._meta.get_field(oldname)] = newname
+                oldfield = model._meta.get_field(oldname)
+                self._by_model[model][oldfield] = newname
+                self._new_names[(model, oldfield.name)] = self._new_names[(model, oldfield.attname)] = newname
         self._by_fieldname = { newname:{ model:model._meta.get_field(oldname)
                                   for model, oldname in changes.items() }
                               for newname, changes in kwargs.items() }
@@ -22,6 +47,11 @@ class Rename:
         return { newname: [(donor._meta.app_label, donor._meta.model_name, field.name) for donor, field in remap.items()]
                  for newname, remap in self._by_fieldname.items() }
 
+    def as_dict(self):
+        # the {newname: {model: oldname}} form that combine.sqlfuncs works with
+        return { newname: { model: field.name for model, field in remap.items() }
+                 for newname, remap in self._by_fieldname.items() }
+
     def old_name(self, contributor_model, newname):
         try:
             return self._by_fieldname[newname][contributor_model].name
@@ -30,15 +60,87 @@ class Rename:
 
     def new_name(self, contributor_model, oldname):
         try:
-            return self._by_model[contributor_model][contributor_model._meta.get_field(oldname)]
+            return self._new_names[(contributor_model, oldname)]
         except KeyError:
             return None
 
 
 class CombineOptions:
-    def __init__(self, donors, renames):
+    def __init__(self, donors, renames, union_all=True, materialized=False, indexes=(), incremental=False,
+                 filters=None):
+        if materialized and incremental:
+            raise ImproperlyConfigured("A Combiner can be materialized or incremental, but not both")
+        if incremental and filters:
+            raise ImproperlyConfigured("An incremental Combiner can't filter its donors")
+        if any(donor not in donors for donor in filters or {}):
+            raise ImproperlyConfigured("A Combiner can only filter its own donors")
         self.donors = tuple([(donor._meta.app_label, donor._meta.model_name) for donor in donors])
+        self.donor_models = tuple(donors)
+        self._donor_indexes = { donor._meta.db_table: index for index, donor in enumerate(donors) }
         self.renames = Rename(**renames)
+        self.union_all = union_all
+        self.materialized = materialized
+        # each index is a tuple of view field names; a bare string is shorthand for a single-column index
+        self.indexes = tuple([ (index,) if isinstance(index, str) else tuple(index) for index in indexes ])
+        self.incremental = incremental
+        # {donor model: Q object} on the donor's own fields, which its rows must match to be in the view
+        self.filters = dict(filters or {})
+        self.model = None # the view model, once it is created
+        self._plan = None
+        self._sources = None
+
+    @property
+    def plan(self):
+        """The view's compiled selection plan (see combine.sqlfuncs.Plan). It is built on first use, by when the app
+        registry is ready, and then shared by everything that generates SQL or rewrites queries for the view."""
+        if self._plan is None:
+            connection = connections[router.db_for_read(self.model)]
+            plan = selection_plan(self.model, self.donor_models, self.renames.as_dict(), union_all=self.union_all,
+                                  connection=connection, filters=self.filters)
+            self._sources = tuple([ { column.target: column.source for column in branch.columns }
+                                    for branch in plan.branches ])
+            self._plan = plan
+        return self._plan
+
+    def deconstruct_filters(self):
+        # the migration-file form of filters, in the order of donors
+        return [ (donor._meta.app_label, donor._meta.model_name, deconstruct_q(self.filters[donor]))
+                 for donor in self.donor_models if donor in self.filters ]
+
+    def source_column(self, position, column):
+        """The column of the donor at position that feeds a view column, or None if the donor contributes NULL or it
+        is a column every donor fills, like the id."""
+        self.plan
+        return self._sources[position].get(column)
+
+    def donor_fields(self, position):
+        """(view field, donor field) pairs for each of the view's own fields: the field of the donor at position that
+        feeds it, or None if the donor contributes NULL."""
+        by_column = { field.column: field for field in self.donor_models[position]._meta.concrete_fields }
+        sources = [ self.source_column(position, field.column)
+                    for field in view_fields(self.model, skip_generated=self.union_all) ]
+        # an inherited field's source is qualified with its parent's table
+        return [ (field, source and by_column.get(source.rpartition('.')[2]))
+                 for field, source in zip(view_fields(self.model, skip_generated=self.union_all), sources) ]
+
+    def split_id(self, view_id):
+        """Splits a view id ("<donor table>.<donor pk>") into the donor's position in donors and its pk. Returns None
+        if the id doesn't belong to any donor."""
+        table, _, pk = str(view_id).partition('.')
+        index = self._donor_indexes.get(table)
+        if index is None:
+            return None
+        try:
+            return index, self.donor_models[index]._meta.pk.to_python(pk)
+        except ValidationError:
+            return None
+
+
+def has_integer_pk(model):
+    pk = model._meta.pk
+    while pk.remote_field is not None: # multi-table inheritance: the pk is a link to the parent's
+        pk = pk.target_field
+    return isinstance(pk, (AutoField, IntegerField))
 
 
 class CombinedModelViewBase(ModelBase):
@@ -50,7 +152,17 @@ class CombinedModelViewBase(ModelBase):
                 new_class = super_new(cls, name, bases, attrs)
             else:
                 # TODO: ensure that combiner's attrs are of correct types (check deeply)
-                combiner = CombineOptions(combiner.donors, combiner.renames)
+                combiner = CombineOptions(combiner.donors, combiner.renames,
+                                          **{ option: getattr(combiner, option, default)
+                                              for option, default in COMBINER_OPTIONS.items() })
+                if combiner.union_all and DISCRIMINATOR not in attrs:
+                    attrs[DISCRIMINATOR] = PositiveSmallIntegerField(editable=False)
+                # Donor pks of other types can share a column too, but its type must then be declared explicitly
+                if combiner.union_all and DONOR_PK not in attrs and all(has_integer_pk(donor)
+                                                                         for donor in combiner.donor_models):
+                    attrs[DONOR_PK] = BigIntegerField(editable=False)
+                if not any(isinstance(value, BaseManager) for value in attrs.values()):
+                    attrs['objects'] = CombinedManager()
 
                 #TODO: disallow ManyToMany fields
                 #TODO: disallow explicit PK field, add our own
@@ -63,11 +175,50 @@ class CombinedModelViewBase(ModelBase):
                     attrs['Meta'] = type('Meta', (), {'managed':False})
                 new_class = super_new(cls, name, bases, attrs)
                 new_class._combiner = combiner
-                # TODO: disallow saves, deletes, mass updates and deletes by wrapping the manager
+                combiner.model = new_class
+                for manager in attrs.values():
+                    if isinstance(manager, CombinedManager) and manager.cache is not None:
+                        manager.cache.watch(new_class)
+                # TODO: disallow saves and deletes of instances; bulk writes go to the donors (see CombinedQuerySet)
             return new_class
         return super_new(cls, name, bases, attrs)
 
 
 class CombinedModelView(six.with_metaclass(CombinedModelViewBase)):
     #utility funcs may go here
-    pass
\ No newline at end of file
+
+    @classmethod
+    def last_refreshed(cls, using=None):
+        """Returns the time a materialized view was last refreshed by refresh(), or None if it never was."""
+        cls._check_materialized()
+        using = using or router.db_for_read(cls)
+        with connections[using].cursor() as cursor:
+            cursor.execute(LAST_REFRESH_SQL, [cls._meta.db_table])
+            row = cursor.fetchone()
+        comment = row[0] if row else None
+        if not comment or not comment.startswith(REFRESH_COMMENT_PREFIX):
+            return None
+        return parse_datetime(comment[len(REFRESH_COMMENT_PREFIX):])
+
+    @classmethod
+    def refresh(cls, concurrently=True, max_staleness=None, using=None):
+        """Refreshes a materialized view. If max_staleness (seconds or a timedelta) is given, views refreshed more
+        recently than that are left alone. Returns whether a refresh took place."""
+        cls._check_materialized()
+        using = using or router.db_for_write(cls)
+        if max_staleness is not None:
+            if not hasattr(max_staleness, 'total_seconds'):
+                max_staleness = timedelta(seconds=max_staleness)
+            last_refreshed = cls.last_refreshed(using=using)
+            if last_refreshed is not None and timezone.now() - last_refreshed < max_staleness:
+                return False
+        with transaction.atomic(using=using), connections[using].cursor() as cursor:
+            cursor.execute(refresh_sql(cls, concurrently=concurrently))
+            cursor.execute(refresh_comment_sql(cls, timezone.now()))
+        invalidate(cls, using=using)
+        return True
+
+    @classmethod
+    def _check_materialized(cls):
+        if not cls._combiner.materialized:
+            raise TypeError("{} is not a materialized combined view".format(cls._meta.object_name))
\ No newline at end of file
@@ -0,0 +1,94 @@
+import hashlib
+from uuid import uuid4
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import EmptyResultSet
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+VERSION_KEY = 'combine:version:{}'
+RESULTS_KEY = 'combine:results:{}'
+
+# The aliases of the caches that keep versions of each watched table, by table
+_watchers = {}
+
+
+class ResultCache:
+    """Opt-in cache of a combined view's query results: CombinedManager(cache=ResultCache(...)). Results are kept in
+    the Django cache named alias, for timeout seconds (the backend's default if not given), under a key made of the
+    query's SQL and params and the current version of each table its rows can come from, including the parents of
+    multi-table inherited donors. Saving or deleting an instance of a donor gives the donor's table a new version, so
+    the results it could have changed are never read again, and are left for the backend to evict. Other writes to a
+    donor must be followed by invalidate()."""
+
+    def __init__(self, alias=DEFAULT_CACHE_ALIAS, timeout=DEFAULT_TIMEOUT):
+        self.alias = alias
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def watch(self, view_model):
+        # The view's own table changes when a materialized view is refreshed, and multi-table inherited donors read
+        # columns from their parents' tables
+        tables = [view_model._meta.db_table]
+        for donor in view_model._combiner.donor_models:
+            tables += [donor._meta.db_table] + [ parent._meta.db_table for parent in donor._meta.get_parent_list() ]
+        for table in tables:
+            _watchers.setdefault(table, set()).add(self.alias)
+        post_save.connect(_instance_changed, dispatch_uid='combine.cache.post_save')
+        post_delete.connect(_instance_changed, dispatch_uid='combine.cache.post_delete')
+
+    def fetch(self, queryset, fetch):
+        """Returns the results of the queryset from the cache, or else fetch()'s, which are then cached."""
+        try:
+            key = self.key(queryset)
+        except EmptyResultSet:
+            return fetch()
+        results = self.cache.get(key)
+        if results is None:
+            results = fetch()
+            # Inside a transaction, the results may include its own writes, so they are kept only once it commits
+            transaction.on_commit(lambda: self.cache.set(key, results, self.timeout), using=queryset.db)
+        return results
+
+    def key(self, queryset):
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        combiner = queryset.model._combiner
+        tables = [queryset.model._meta.db_table]
+        for position in sorted(queryset.query.possible_donor_positions()):
+            tables += [combiner.donor_models[position]._meta.db_table] + [
+                join.db_table for join in combiner.plan.branches[position].joins ]
+        definition = repr((queryset.db, queryset._iterable_class.__name__, sql, params, self.versions(tables)))
+        return RESULTS_KEY.format(hashlib.sha1(definition.encode('utf-8')).hexdigest())
+
+    def versions(self, tables):
+        keys = [ VERSION_KEY.format(table) for table in tables ]
+        versions = self.cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                # add() rather than set(), so that concurrent readers agree on the first version
+                self.cache.add(key, uuid4().hex, None)
+                versions[key] = self.cache.get(key)
+        return tuple(versions[key] for key in keys)
+
+
+def invalidate(model, using=None):
+    """Gives the model's table, and those of its multi-table inheritance parents, new versions in every result cache
+    watching them, at once and again when the transaction on the using database commits, in case other connections
+    cached what they read before it. Call it after changing a donor without sending post_save or post_delete, as
+    QuerySet.update(), bulk_create() and raw SQL do."""
+    _bump_versions(model)
+    transaction.on_commit(lambda: _bump_versions(model), using=using)
+
+
+def _bump_versions(model):
+    for table in [model._meta.db_table] + [ parent._meta.db_table for parent in model._meta.get_parent_list() ]:
+        for alias in _watchers.get(table, ()):
+            caches[alias].set(VERSION_KEY.format(table), uuid4().hex, None)
+
+
+def _instance_changed(sender, using=None, **kwargs):
+    invalidate(sender, using=using)
@@ -0,0 +1,41 @@
+import sys
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from ...base import CombinedModelView
+from ...query import COPY_FORMATS
+
+
+class Command(BaseCommand):
+    help = 'Exports a combined view with COPY ... TO STDOUT, to a file or standard output.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='The combined view, as app_label.ModelName.')
+        parser.add_argument('--format', choices=COPY_FORMATS, default='csv',
+                            help='COPY format of the output. Defaults to csv.')
+        parser.add_argument('--no-header', action='store_false', dest='header',
+                            help='Leave out the csv header row.')
+        parser.add_argument('--parallel', action='store_true',
+                            help='Run one COPY per donor on its own connection, and write their outputs one after '
+                                 'the other.')
+        parser.add_argument('--output', '-o', default=None,
+                            help='File to write to. Defaults to standard output.')
+        parser.add_argument('--database', default=None,
+                            help='Nominates a database to export the view from.')
+
+    def handle(self, model, **options):
+        try:
+            model = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not issubclass(model, CombinedModelView):
+            raise CommandError("{} is not a combined view".format(model._meta.label))
+        queryset = model._default_manager.using(options['database'])
+        if options['output']:
+            with open(options['output'], 'wb') as file:
+                rows = queryset.copy_to(file, options['format'], options['header'], options['parallel'])
+        else:
+            rows = queryset.copy_to(sys.stdout.buffer, options['format'], options['header'], options['parallel'])
+        if options['verbosity'] >= 1 and options['output']:
+            self.stdout.write("Exported {} rows of {}".format(rows, model._meta.label))
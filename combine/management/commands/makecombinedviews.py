@@ -1,9 +1,7 @@
 from unittest.mock import patch
 import sys
-import warnings
 from itertools import chain
 
-from django.core.management.base import BaseCommand, CommandError
 from django.core.management.commands import makemigrations
 
 from django.apps import apps
@@ -11,12 +9,17 @@ from django.apps import apps
 from django.db.migrations import Migration
 from django.db.migrations.autodetector import MigrationAutodetector
 from django.db.migrations.loader import MigrationLoader
-from django.db.migrations.operations import CreateModel
+from django.db.migrations.operations import AlterField, CreateModel, RemoveField, RenameField
 from django.db.migrations.state import ProjectState
-from django.utils.deprecation import RemovedInDjango20Warning
+from django.db.migrations.writer import MigrationWriter
 
 from ...base import CombinedModelViewBase, CombinedModelView
-from ...operations import CreateCombinedView, RemoveCombinedView
+from ...sqlfuncs import DISCRIMINATOR
+from ...operations import (AlterCombinedView, CombinedViewOperation, CreateCombinedView, DropCombinedViews,
+                           RecreateCombinedViews, RemoveCombinedView, view_fingerprint)
+
+# Donor field changes that a combined view reading the field would block or be broken by
+DONOR_FIELD_OPERATIONS = (AlterField, RemoveField, RenameField)
 
 
 #Combined view gathering for custom migrations
@@ -33,6 +36,51 @@ def gather_combined_models(labels = None):
     return { (model._meta.app_label, model._meta.model_name) : model for model in model_iter }
 
 
+def view_definition(model):
+    # The keyword arguments of a CombinedViewOperation for the combined model's current definition
+    combiner = model._combiner
+    definition = { 'donors': combiner.donors, 'renames': combiner.renames.deconstruct(),
+                   'union_all': combiner.union_all, 'materialized': combiner.materialized,
+                   'indexes': combiner.indexes, 'incremental': combiner.incremental,
+                   'filters': combiner.deconstruct_filters() }
+    definition['fingerprint'] = view_fingerprint(columns=model_columns(model), **definition)
+    return definition
+
+
+def model_columns(model):
+    return [ (field.name, field.db_column) for field in model._meta.local_fields ]
+
+
+def latest_view_operations(graph):
+    # The operation that last defined each combined view, by (app_label, model_name), in the graph's order
+    return { key: operation for key, (node, operation) in latest_view_nodes(graph).items() }
+
+
+def latest_view_nodes(graph):
+    # As latest_view_operations(), with the key of the migration each operation is in
+    latest = {}
+    seen = set()
+    for leaf in sorted(graph.leaf_nodes()):
+        for node in graph.forwards_plan(leaf):
+            if node in seen:
+                continue
+            seen.add(node)
+            for operation in graph.nodes[node].operations:
+                if isinstance(operation, RecreateCombinedViews):
+                    for app_label, view_operation in operation.view_operations():
+                        latest[(app_label, view_operation.name.lower())] = (node, view_operation)
+                elif isinstance(operation, RemoveCombinedView):
+                    latest.pop((node[0], operation.name.lower()), None)
+                elif isinstance(operation, CombinedViewOperation):
+                    latest[(node[0], operation.name.lower())] = (node, operation)
+    return latest
+
+
+def changed_donor_field(operation):
+    # The field a DONOR_FIELD_OPERATIONS operation changes, as it was named before
+    return operation.old_name if isinstance(operation, RenameField) else operation.name
+
+
 class CombinedViewCheckingCreateModel(CreateModel):
     def references_model(self, name, app_label=None):
         if any(isinstance(base, CombinedModelViewBase) for base in self.bases):
@@ -40,77 +88,187 @@ class CombinedViewCheckingCreateModel(CreateModel):
         return super(CreateModel, self).references_model(name, app_label)
 
 
+class NonAtomicMigrationWriter(MigrationWriter):
+    # Django's writer leaves out a migration's atomic attribute
+    def as_string(self):
+        output = super(NonAtomicMigrationWriter, self).as_string()
+        if self.migration.atomic:
+            return output
+        return output.replace("\nclass Migration(migrations.Migration):\n",
+                              "\nclass Migration(migrations.Migration):\n\n    atomic = False\n", 1)
+
+
 class Command(makemigrations.Command):
     help = 'Runs makemigrations with some injected code that causes makemigrations to ignore combined model views, ' \
-           'then adds the combined model views separately.'
+           'then adds migrations creating, altering or removing the combined model views whose definitions changed.'
 
 
     """To avoid the risk of overloading names from the makemigrations.Command class, I've prefixed all attributes
     I assign to this Command class, or an instance thereof, with '_mcv_' (short for 'Make Combined Views'). This
     convention makes it unlikely that my names will ever collide with Django's, even if updates are made to the
     Django makemigrations script."""
-    def _mcv_step2_init(self, *app_labels, **options):
-        self._mcv_loader = MigrationLoader(None)
-        self._mcv_combined_model_nodes = {tup_id: migration
-                                          for tup_id, migration in self._mcv_loader.graph.nodes.items()
-                                          if any([type(op) == CreateCombinedView for op in migration.operations])}
-        self._mcv_current_combined_models = gather_combined_models()
-        self._mcv_current_state = self._mcv_loader.project_state()
-        self._mcv_latest_combined_model_state = self._mcv_loader.project_state(nodes=list(self._mcv_combined_model_nodes.keys()))
+    _mcv_loader = None
+    _mcv_state = None
 
     def handle(self, *app_labels, **options):
+        self._mcv_loader = None
+        self._mcv_state = None
+        self._mcv_written = []
 
         """A filthy hack. Can't be helped so far as I can tell because Django makes the assumption
         that, other than /the class Model/, all classes whose metaclasses inherit from ModelBase are user-defined
         models that need to have normal migration logic applied to them. This usually doesn't matter, since
         CombinedModelViews are forced to be unmanaged (see combine.base.CombinedModelViewBase). However,
-        the CreateModel operation is applied even to unmanaged models. So we have to monkey patch it."""
-        with patch('django.db.migrations.operations.CreateModel',
-                   new=CombinedViewCheckingCreateModel):
-            super(Command, self).handle(*app_labels, **options)
+        the CreateModel operation is applied even to unmanaged models. So we have to monkey patch it.
 
-        #TODO: Handle wacky makemigrations options such as --dry-run.
+        makemigrations' MigrationLoader is patched too, only to keep hold of it: loading the graph is the slow part
+        on projects with many migrations, so the combined views are planned against the same one."""
+        with patch('django.db.migrations.operations.CreateModel', new=CombinedViewCheckingCreateModel), \
+             patch.object(makemigrations, 'MigrationLoader', new=self._mcv_load):
+            super(Command, self).handle(*app_labels, **options)
+        if options['merge'] or options['empty']:
+            return
 
-        self._mcv_step2_init(*app_labels, **options)
+        loader = self._mcv_loader or MigrationLoader(None, ignore_no_migrations=True)
+        self._mcv_add_written_migrations(loader.graph)
+        operations = self._mcv_view_operations(loader, app_labels)
+        if not operations:
+            if self.verbosity >= 1:
+                self.stdout.write("No changes detected in combined views")
+            return
 
-        models_to_add, models_to_remove = self._mcv_get_combined_model_additions_and_removals()
-        app_labels_to_use = set([label_and_model[0] for label_and_model in models_to_add]).union(
-                            set([label_and_model[0] for label_and_model in models_to_remove]))
-        operations = { label: [] for label in app_labels_to_use }
-        for app_label, model_name in models_to_add:
-            model = self._mcv_current_combined_models[(app_label, model_name)]
-            donors = model._combiner.donors
-            renames = model._combiner.renames.deconstruct()
-            operations[app_label].append(CreateCombinedView(model._meta.object_name, donors, renames))
         changes = {}
-        for label, op_list in operations.items():
+        for app_label, op_list in operations.items():
             subclass = type(str("Migration"), (Migration,), {"operations": op_list, "dependencies": []})
-            instance = subclass("combinedview", app_label)
-            changes[label] = [instance]
-        # TODO: Record model changes among models
+            changes[app_label] = [subclass("combinedview", app_label)]
         #I don't actually care about autodetecting anything, I just want the arrange_for_graph() method
-        autodetector = MigrationAutodetector(
-            self._mcv_loader.project_state(),
-            ProjectState.from_apps(apps)
-        )
-        changes = autodetector.arrange_for_graph(changes, self._mcv_loader.graph)
-        if changes:
-            self.write_migration_files(changes)
-
-    def _mcv_historical_combined_models(self):
-        # TODO: Currently counts all combined models that EVER existed, but should instead check the state history to
-        # prune out overwritten/deleted combined models
-        to_return = {}
-        for app_label, migration_name in self._mcv_combined_model_nodes.keys():
-            migration = self._mcv_combined_model_nodes[(app_label, migration_name)]
-            model_name = [ o for o in migration.operations if type(o) == CreateCombinedView ][0].name.lower()
-            to_return[(app_label, model_name)] = self._mcv_latest_combined_model_state.models[(app_label, model_name)]
-        return to_return
-
-    def _mcv_get_combined_model_additions_and_removals(self):
-        #returns a 2-tuple of sets of (app_label, model) 2-tuples
-        historic_combined_model_identifiers = set(self._mcv_historical_combined_models().keys())
-        current_combined_model_identifiers = set(self._mcv_current_combined_models.keys())
-        models_to_add = current_combined_model_identifiers - historic_combined_model_identifiers
-        models_to_remove = historic_combined_model_identifiers - current_combined_model_identifiers
-        return (models_to_add, models_to_remove)
\ No newline at end of file
+        autodetector = MigrationAutodetector(ProjectState(), ProjectState())
+        changes = autodetector.arrange_for_graph(changes, loader.graph, self.migration_name or 'combined_views')
+        self.write_migration_files(changes)
+        if options['check_changes']:
+            sys.exit(1)
+
+    def write_migration_files(self, changes):
+        self._mcv_bracket_donor_changes(changes)
+        self._mcv_written.extend((app_label, migration)
+                                 for app_label, migrations in changes.items() for migration in migrations)
+        # An AlterCombinedView's swap only commits, and releases its locks, on its own outside of a transaction
+        for migrations in changes.values():
+            for migration in migrations:
+                if any(isinstance(operation, AlterCombinedView) for operation in migration.operations):
+                    migration.atomic = False
+        with patch.object(makemigrations, 'MigrationWriter', new=NonAtomicMigrationWriter):
+            super(Command, self).write_migration_files(changes)
+
+    def _mcv_load(self, *args, **kwargs):
+        self._mcv_loader = MigrationLoader(*args, **kwargs)
+        return self._mcv_loader
+
+    def _mcv_bracket_donor_changes(self, changes):
+        """Combined views reading donor fields that a new migration alters, renames or removes are dropped before the
+        first such operation and recreated, as currently defined, after the last one. All of the migration's affected
+        views are dropped and recreated together, so it doesn't rebuild a view once per donor change."""
+        if self._mcv_loader is None:
+            return
+        deployed = latest_view_nodes(self._mcv_loader.graph)
+        current = gather_combined_models()
+        state = None
+        for app_label, migrations in changes.items():
+            for migration in migrations:
+                if not deployed or not any(isinstance(operation, DONOR_FIELD_OPERATIONS)
+                                           for operation in migration.operations):
+                    continue
+                state = state or self._mcv_loader.project_state()
+                positions = []
+                affected = set()
+                for position, operation in enumerate(migration.operations):
+                    if not isinstance(operation, DONOR_FIELD_OPERATIONS):
+                        continue
+                    readers = { key for key, (node, view_operation) in deployed.items()
+                                if view_operation.depends_on_field(key[0], state,
+                                                                   (app_label, operation.model_name_lower),
+                                                                   changed_donor_field(operation)) }
+                    if readers:
+                        positions.append(position)
+                        affected |= readers
+                if not affected:
+                    continue
+                affected = sorted(affected)
+                drop = DropCombinedViews([ (key[0], dict(self._mcv_arguments(deployed[key][1]),
+                                                         name=deployed[key][1].name))
+                                           for key in affected ])
+                recreate = RecreateCombinedViews([ (key[0], dict(view_definition(current[key]),
+                                                                 name=current[key]._meta.object_name))
+                                                   for key in affected if key in current ])
+                first, last = positions[0], positions[-1] + 1
+                migration.operations = migration.operations[:first] + [drop] + migration.operations[first:last] + \
+                                       ([recreate] if recreate.views else []) + migration.operations[last:]
+                # The views' own migrations, so that the views are in the migration's state
+                for node, _ in (deployed[key] for key in affected):
+                    if node[0] != app_label and node not in migration.dependencies:
+                        migration.dependencies.append(node)
+
+    def _mcv_add_written_migrations(self, graph):
+        # makemigrations' new migrations aren't in the graph it loaded, but the combined views' must follow them
+        for app_label, migration in self._mcv_written:
+            graph.add_node((app_label, migration.name), migration)
+        for app_label, migration in self._mcv_written:
+            for parent in migration.dependencies:
+                if tuple(parent) in graph.nodes:
+                    graph.add_dependency(migration, (app_label, migration.name), tuple(parent))
+
+    def _mcv_project_state(self, loader):
+        # Only needed for views last migrated without a fingerprint, so built at most once, and only if needed
+        if self._mcv_state is None:
+            self._mcv_state = loader.project_state()
+        return self._mcv_state
+
+    def _mcv_view_operations(self, loader, app_labels=()):
+        # The operations that bring each app's combined views up to date, by app_label
+        latest = latest_view_operations(loader.graph)
+        current = gather_combined_models(app_labels or None)
+        operations = {}
+        for key in sorted(current):
+            model = current[key]
+            definition = view_definition(model)
+            operation = latest.get(key)
+            if operation is None:
+                new_operation = CreateCombinedView(model._meta.object_name, **definition)
+            elif self._mcv_fingerprint(loader, key, operation) != definition['fingerprint']:
+                new_operation = AlterCombinedView(model._meta.object_name, previous=self._mcv_arguments(operation),
+                                                  **definition)
+                if definition['union_all'] and not operation.union_all:
+                    # union_all became the default, so views migrated before it change without their Combiners doing
+                    self.stderr.write(self.style.WARNING(
+                        "{}.{} is a UNION view, and this migration makes it a UNION ALL view with a '{}' column. Set "
+                        "union_all = False in its Combiner to keep it as it is.".format(key[0], model.__name__,
+                                                                                       DISCRIMINATOR)))
+            else:
+                continue
+            operations.setdefault(key[0], []).append(new_operation)
+        for key in sorted(latest):
+            if key in current or (app_labels and key[0] not in app_labels):
+                continue
+            arguments = self._mcv_arguments(latest[key])
+            arguments['db_table'] = self._mcv_db_table(loader, key, latest[key])
+            operations.setdefault(key[0], []).append(RemoveCombinedView(latest[key].name, **arguments))
+        return operations
+
+    def _mcv_arguments(self, operation):
+        arguments = { 'donors': operation.donors, 'renames': operation.renames,
+                      'fingerprint': operation.fingerprint, 'db_table': operation.db_table }
+        arguments.update(operation.options())
+        return arguments
+
+    def _mcv_fingerprint(self, loader, key, operation):
+        if operation.fingerprint is not None:
+            return operation.fingerprint
+        model_state = self._mcv_project_state(loader).models.get(key)
+        columns = [ (name, field.db_column) for name, field in model_state.fields ] if model_state else []
+        return view_fingerprint(operation.donors, operation.renames, columns, **operation.options())
+
+    def _mcv_db_table(self, loader, key, operation):
+        if operation.db_table is not None:
+            return operation.db_table
+        model_state = self._mcv_project_state(loader).models.get(key)
+        return (model_state and model_state.options.get('db_table')) or '{}_{}'.format(*key)
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from .makecombinedviews import gather_combined_models
+
+
+class Command(BaseCommand):
+    help = 'Refreshes materialized combined views, skipping any refreshed within the last --max-staleness seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('app_label', nargs='*',
+                            help='Only refresh the materialized combined views of these apps.')
+        parser.add_argument('--max-staleness', type=float, default=None,
+                            help='Staleness budget in seconds. Views refreshed more recently than this are skipped. '
+                                 'By default every view is refreshed.')
+        parser.add_argument('--no-concurrently', action='store_false', dest='concurrently',
+                            help='Use a plain REFRESH, which blocks reads of the view while it runs.')
+        parser.add_argument('--database', default=None,
+                            help='Nominates a database to refresh the views in.')
+
+    def handle(self, *app_labels, **options):
+        try:
+            combined_models = gather_combined_models(app_labels or None)
+        except LookupError as e:
+            raise CommandError(str(e))
+        for identifier in sorted(combined_models):
+            model = combined_models[identifier]
+            if not model._combiner.materialized:
+                continue
+            refreshed = model.refresh(concurrently=options['concurrently'],
+                                      max_staleness=options['max_staleness'],
+                                      using=options['database'])
+            if options['verbosity'] >= 1:
+                self.stdout.write("{} {}.{}".format('Refreshed' if refreshed else 'Skipped (fresh)',
+                                                    model._meta.app_label, model._meta.object_name))
@@ -1,7 +1,82 @@
+import hashlib
+import json
+import time
+from types import SimpleNamespace
+
 from django.db.migrations.operations.base import Operation
-from django.db import router
+from django.db import OperationalError, router, transaction
+from django.db.models import Q
+from django.db.models.constants import LOOKUP_SEP
+
+from .sqlfuncs import (SET_LOCK_TIMEOUT_SQL, SHOW_LOCK_TIMEOUT_SQL, construction_sql, destruction_sql, swap_name,
+                       swap_sql)
+
+# How long AlterCombinedView's swap waits for its locks before it gives up, and how often it tries again
+SWAP_LOCK_TIMEOUT = '2s'
+SWAP_RETRIES = 5
+SWAP_RETRY_DELAY = 1.0 # seconds, doubled after each attempt
+LOCK_NOT_AVAILABLE = '55P03' # Postgres' error code for a lock_timeout
+
+
+def view_fingerprint(donors, renames, columns, union_all=False, materialized=False, indexes=(), incremental=False,
+                     filters=()):
+    """A short digest of everything a combined view's SQL is generated from: its donors, renames and options (in
+    their deconstructed, migration-file form) and its columns, as (field name, db_column) pairs in field order."""
+    definition = [ [ list(donor) for donor in donors ],
+                   sorted([ newname, sorted([ list(rename) for rename in remap ]) ]
+                          for newname, remap in renames.items()),
+                   [ list(column) for column in columns ],
+                   bool(union_all), bool(materialized), [ list(index) for index in indexes ], bool(incremental) ]
+    if filters:
+        # only when there are any, so that views without them keep the fingerprints they were migrated with
+        definition.append([ list(donor_filter) for donor_filter in filters ])
+    # filter values can be dates and the like, which are digested by their repr
+    return hashlib.sha1(json.dumps(definition, default=repr).encode('utf-8')).hexdigest()[:16]
+
+
+def state_ancestors(state, model_key):
+    # The (app_label, model_name) keys of a model's multi-table inheritance ancestors in the project state
+    ancestors = []
+    pending = [model_key]
+    while pending:
+        model_state = state.models.get(pending.pop())
+        for base in (model_state.bases if model_state is not None else ()):
+            if isinstance(base, str):
+                key = tuple(base.lower().split('.', 1))
+            elif hasattr(base, '_meta') and not base._meta.abstract:
+                key = (base._meta.app_label, base._meta.model_name)
+            else:
+                continue
+            if key in state.models and key not in ancestors:
+                ancestors.append(key)
+                pending.append(key)
+    return ancestors
+
 
-from .sqlfuncs import construction_sql, destruction_sql
+def deconstruct_q(q_object):
+    """The migration-file form of a Q object: a dict of its connector, whether it is negated, and its children, each
+    a (lookup, value) pair or another such dict."""
+    return { 'connector': q_object.connector, 'negated': q_object.negated,
+             'children': [ deconstruct_q(child) if isinstance(child, Q) else tuple(child)
+                           for child in q_object.children ] }
+
+
+def reconstruct_q(deconstructed):
+    q_object = Q()
+    q_object.connector = deconstructed['connector']
+    q_object.negated = deconstructed['negated']
+    q_object.children = [ reconstruct_q(child) if isinstance(child, dict) else tuple(child)
+                          for child in deconstructed['children'] ]
+    return q_object
+
+
+def q_field_names(deconstructed):
+    # The names of the fields a deconstructed Q object's lookups start from
+    for child in deconstructed['children']:
+        if isinstance(child, dict):
+            yield from q_field_names(child)
+        else:
+            yield child[0].split(LOOKUP_SEP)[0]
 
 
 class CombinedViewOperation(Operation):
@@ -9,27 +84,66 @@ class CombinedViewOperation(Operation):
     reduces_to_sql = True
     reversible = True
 
-    def __init__(self, name, donors, renames, hints=None):
+    def __init__(self, name, donors, renames, hints=None, union_all=False, materialized=False, indexes=(),
+                 incremental=False, fingerprint=None, db_table=None, filters=()):
         self.name = name
         self.donors = donors # (app_label, model) list
         self.renames = renames
-        self.hints = hints
+        self.hints = hints or {}
+        # Defaults to False so that migrations written before UNION ALL views existed keep creating UNION views
+        self.union_all = union_all
+        self.materialized = materialized
+        self.indexes = indexes
+        self.incremental = incremental
+        self.filters = filters # (app_label, model, deconstruct_q() of the Q object) list
+        # view_fingerprint() of the definition when the operation was written; None in older migrations
+        self.fingerprint = fingerprint
+        # the view's table, for removing a view whose model is already gone from the migration state
+        self.db_table = db_table
+
+    def options(self):
+        return { 'union_all': self.union_all, 'materialized': self.materialized, 'indexes': self.indexes,
+                 'incremental': self.incremental, 'filters': self.filters }
 
     def state_forwards(self, app_label, state):
         # model should be added as unmanaged already so python state should not change
         pass
 
     def _database_create(self, app_label, schema_editor, state):
+        self._run_sql(self._construction_sql(app_label, schema_editor, state), schema_editor, app_label)
+
+    def _construction_sql(self, app_label, schema_editor, state, db_view=None):
         view_model = self._get_reconstructed_view_model(app_label, state)
         donors = self._get_reconstructed_donors(state)
         renames = self._get_reconstructed_renames(state)
-        create_sql = construction_sql(view_model, donors, renames)
-        self._run_sql(create_sql, schema_editor, app_label)
+        return construction_sql(view_model, donors, renames, union_all=self.union_all,
+                                materialized=self.materialized, indexes=self.indexes,
+                                incremental=self.incremental, connection=schema_editor.connection, db_view=db_view,
+                                filters=self._get_reconstructed_filters(state))
 
     def _database_remove(self, app_label, schema_editor, state):
+        self._run_sql(self._destruction_sql(app_label, state), schema_editor, app_label)
+
+    def _destruction_sql(self, app_label, state, db_view=None):
+        try:
+            view_model = self._get_reconstructed_view_model(app_label, state)
+        except LookupError:
+            if self.db_table is None:
+                raise
+            # only the table name is needed to drop the view
+            view_model = SimpleNamespace(_meta=SimpleNamespace(db_table=self.db_table))
+        try:
+            donors = self._get_reconstructed_donors(state)
+        except LookupError:
+            donors = [] # dropping a donor table took its sync trigger with it
+        return destruction_sql(view_model, materialized=self.materialized, incremental=self.incremental,
+                               donors=donors, db_view=db_view)
+
+    def _swap_sql(self, app_label, state):
         view_model = self._get_reconstructed_view_model(app_label, state)
-        remove_sql = destruction_sql(view_model)
-        self._run_sql(remove_sql, schema_editor, app_label)
+        return swap_sql(view_model, self._get_reconstructed_donors(state), self._get_reconstructed_renames(state),
+                        union_all=self.union_all, materialized=self.materialized, indexes=self.indexes,
+                        incremental=self.incremental)
 
     def _run_sql(self, sqls, schema_editor, app_label):
         if router.allow_migrate(schema_editor.connection.alias, app_label, **self.hints):
@@ -37,6 +151,29 @@ class CombinedViewOperation(Operation):
             for statement in statements:
                 schema_editor.execute(statement, params=None)
 
+    def depends_on_field(self, app_label, state, donor, field_name):
+        """Whether the view, of the app app_label, may read the field of the donor, an (app_label, model_name) pair,
+        in the project state: as its primary key, through a rename or a filter, or by having a field of the same
+        name. The donor can also be a multi-table inheritance parent of one of the view's donors."""
+        donor = (donor[0], donor[1].lower())
+        donors = [ (donor_app, donor_name.lower()) for donor_app, donor_name in self.donors ]
+        # the view's donors that have the donor's fields
+        heirs = [donor] if donor in donors else [ key for key in donors if donor in state_ancestors(state, key) ]
+        if not heirs:
+            return False
+        if any((donor_app, donor_name.lower()) in heirs and old_name == field_name
+               for remap in self.renames.values() for donor_app, donor_name, old_name in remap):
+            return True
+        if any((donor_app, donor_name.lower()) in heirs and field_name in q_field_names(deconstructed)
+               for donor_app, donor_name, deconstructed in self.filters):
+            return True
+        donor_state = state.models.get(donor)
+        if donor_state is not None and any(field.primary_key for name, field in donor_state.fields
+                                           if name == field_name):
+            return True
+        view_state = state.models.get((app_label, self.name.lower()))
+        return view_state is not None and any(name == field_name for name, _ in view_state.fields)
+
     def _get_reconstructed_view_model(self, app_label, state):
         return state.apps.get_model(app_label, self.name)
 
@@ -51,6 +188,10 @@ class CombinedViewOperation(Operation):
                 renames[new_field_name][state.apps.get_model(app_label, donor_name)] = old_field_name
         return renames
 
+    def _get_reconstructed_filters(self, state):
+        return { state.apps.get_model(app_label, donor_name): reconstruct_q(deconstructed)
+                 for app_label, donor_name, deconstructed in self.filters }
+
     def describe(self):
         return "Create view model {} combining {}".format(self.name, self.donors)
 
@@ -67,6 +208,72 @@ class CreateCombinedView(CombinedViewOperation):
         return "Create view model {} combining {}".format(self.name, self.donors)
 
 
+class AlterCombinedView(CombinedViewOperation):
+    """Replaces a combined view's definition. previous holds the keyword arguments of the operation that defined
+    it before, so that it can be dropped, and recreated when migrating backwards.
+
+    The new definition is built under a swap name first, while the old one keeps serving reads. Only dropping the old
+    one and renaming the new one into its place needs locks that block readers, and that is done in a transaction of
+    its own that waits at most lock_timeout for them, and is retried up to retries times if it times out. In an atomic
+    migration that transaction is only a savepoint, and the locks are held until the whole migration commits, so
+    makecombinedviews writes the migrations with an AlterCombinedView as atomic = False."""
+
+    def __init__(self, name, donors, renames, hints=None, union_all=False, materialized=False, indexes=(),
+                 incremental=False, fingerprint=None, db_table=None, filters=(), previous=None,
+                 lock_timeout=SWAP_LOCK_TIMEOUT, retries=SWAP_RETRIES, retry_delay=SWAP_RETRY_DELAY):
+        super(AlterCombinedView, self).__init__(name, donors, renames, hints=hints, union_all=union_all,
+                                                materialized=materialized, indexes=indexes, incremental=incremental,
+                                                fingerprint=fingerprint, db_table=db_table, filters=filters)
+        self.previous = previous or {}
+        self.lock_timeout = lock_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def _previous_operation(self):
+        return CombinedViewOperation(self.name, hints=self.hints, **self.previous)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._database_swap(app_label, schema_editor, self._previous_operation(), from_state, self, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._database_swap(app_label, schema_editor, self, from_state, self._previous_operation(), to_state)
+
+    def _database_swap(self, app_label, schema_editor, old, old_state, new, new_state):
+        if not router.allow_migrate(schema_editor.connection.alias, app_label, **self.hints):
+            return
+        db_swap = swap_name(new._get_reconstructed_view_model(app_label, new_state)._meta.db_table)
+        # Whatever an earlier, failed swap left behind is dropped first
+        build_sql = new._destruction_sql(app_label, new_state, db_view=db_swap) + \
+                    new._construction_sql(app_label, schema_editor, new_state, db_view=db_swap)
+        self._run_sql(build_sql, schema_editor, app_label)
+        swap = old._destruction_sql(app_label, old_state) + new._swap_sql(app_label, new_state)
+        if schema_editor.collect_sql:
+            self._run_sql(swap, schema_editor, app_label)
+            return
+        for attempt in range(self.retries + 1):
+            try:
+                with transaction.atomic(using=schema_editor.connection.alias):
+                    self._run_sql_with_lock_timeout(swap, schema_editor, app_label)
+                return
+            except OperationalError as e:
+                if getattr(e.__cause__, 'pgcode', None) != LOCK_NOT_AVAILABLE or attempt == self.retries:
+                    raise
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+    def _run_sql_with_lock_timeout(self, sqls, schema_editor, app_label):
+        # In an atomic migration, the setting would otherwise outlast the swap's savepoint
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(SHOW_LOCK_TIMEOUT_SQL)
+            previous_timeout = cursor.fetchone()[0]
+            cursor.execute(SET_LOCK_TIMEOUT_SQL, [str(self.lock_timeout)])
+        self._run_sql(sqls, schema_editor, app_label)
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(SET_LOCK_TIMEOUT_SQL, [previous_timeout])
+
+    def describe(self):
+        return "Alter view model {} combining {}".format(self.name, self.donors)
+
+
 class RemoveCombinedView(CombinedViewOperation):
 
     def database_forwards(self, app_label, schema_editor, from_state, to_state):
@@ -76,4 +283,59 @@ class RemoveCombinedView(CombinedViewOperation):
         self._database_create(app_label, schema_editor, from_state)
 
     def describe(self):
-        return "Create view model {} combining {}".format(self.name, self.donors)
\ No newline at end of file
+        return "Remove view model {} combining {}".format(self.name, self.donors)
+
+class CombinedViewsOperation(Operation):
+    """Base of the operations that drop or recreate several combined views, possibly of other apps, at once. views is a
+    list of (app_label, keyword arguments of a CombinedViewOperation, name included) pairs."""
+
+    reduces_to_sql = True
+    reversible = True
+
+    def __init__(self, views, hints=None):
+        self.views = views
+        self.hints = hints or {}
+
+    def view_operations(self):
+        return [ (app_label, CombinedViewOperation(hints=self.hints, **arguments))
+                 for app_label, arguments in self.views ]
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def _database_create(self, schema_editor, state):
+        for app_label, operation in self.view_operations():
+            operation._database_create(app_label, schema_editor, state)
+
+    def _database_remove(self, schema_editor, state):
+        for app_label, operation in self.view_operations():
+            operation._database_remove(app_label, schema_editor, state)
+
+    def _view_names(self):
+        return ', '.join('{}.{}'.format(app_label, arguments['name']) for app_label, arguments in self.views)
+
+
+class DropCombinedViews(CombinedViewsOperation):
+    """Drops the combined views that read donor fields the operations after it alter, rename or remove, which the
+    views would block or be broken by. RecreateCombinedViews builds them again after those operations."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._database_remove(schema_editor, from_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._database_create(schema_editor, to_state)
+
+    def describe(self):
+        return "Drop view models {} ahead of donor changes".format(self._view_names())
+
+
+class RecreateCombinedViews(CombinedViewsOperation):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        self._database_create(schema_editor, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        self._database_remove(schema_editor, from_state)
+
+    def describe(self):
+        return "Recreate view models {} after donor changes".format(self._view_names())
@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import total_ordering
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+
+from django.db import connections
+
+QUEUE_POLL_SECONDS = 0.1
+_DONE = object()
+
+
+def on_own_connection(func, using):
+    # Django connections are per thread; a worker thread must close the one it opened, or it is leaked
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connections[using].close()
+    return wrapper
+
+
+def parallel_map(func, items, using, max_workers=None):
+    """Calls func on each item, each call on its own thread and database connection, and returns the results in
+    order."""
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers or len(items)) as executor:
+        return list(executor.map(on_own_connection(func, using), items))
+
+
+def parallel_streams(iterable_factories, using, chunk_size=100, buffered_chunks=4):
+    """Runs each of the zero-argument callables on its own thread and database connection, and returns one lazy
+    iterator per callable over the iterable it returned. Each thread stays at most buffered_chunks chunks ahead of its
+    consumer. Abandoning any of the returned iterators early (closing it, or letting it be garbage collected) stops all
+    of the threads."""
+    stop = Event()
+    queues = [ Queue(maxsize=buffered_chunks) for _ in iterable_factories ]
+
+    def put(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=QUEUE_POLL_SECONDS)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce(factory, queue):
+        try:
+            chunk = []
+            for item in factory():
+                chunk.append(item)
+                if len(chunk) >= chunk_size:
+                    if not put(queue, chunk):
+                        return
+                    chunk = []
+            if chunk and not put(queue, chunk):
+                return
+            put(queue, _DONE)
+        except Exception as e:
+            put(queue, e)
+
+    def consume(queue):
+        finished = False
+        try:
+            while True:
+                try:
+                    chunk = queue.get(timeout=QUEUE_POLL_SECONDS)
+                except Empty:
+                    if stop.is_set():
+                        return
+                    continue
+                if chunk is _DONE:
+                    finished = True
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                for item in chunk:
+                    yield item
+        finally:
+            if not finished:
+                stop.set()
+
+    for factory, queue in zip(iterable_factories, queues):
+        Thread(target=on_own_connection(produce, using), args=(factory, queue), daemon=True).start()
+    return [ consume(queue) for queue in queues ]
+
+
+@total_ordering
+class Descending:
+    """Sort key wrapper that inverts the order of the value it wraps."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def nulls_last(value):
+    # Postgres sorts NULLs after every other value, ascending; Descending flips that to first, as Postgres does
+    return (value is None, value if value is not None else 0)
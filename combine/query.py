@@ -0,0 +1,1280 @@
+import codecs
+import csv
+import heapq
+import io
+import json
+import struct
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+from itertools import chain, islice
+from operator import attrgetter, itemgetter
+from tempfile import SpooledTemporaryFile
+
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.db.models import AutoField, Avg, CharField, Count, F, Manager, Max, Min, Model, Q, Sum, TextField
+from django.db.models.expressions import Col, RawSQL, Star, Subquery
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import FlatValuesListIterable, ModelIterable, QuerySet, ValuesIterable
+from django.db.models.sql.constants import CURSOR, MULTI
+from django.db.models.sql.datastructures import BaseTable
+from django.db.models.sql.query import Query
+from django.db.models.sql.where import ExtraWhere, NothingNode, SubqueryConstraint, WhereNode
+
+from .cache import invalidate
+from .parallel import Descending, nulls_last, parallel_map, parallel_streams
+from .sqlfuncs import (DISCRIMINATOR, DONOR_PK, ESTIMATED_ROWS_SQL, GENERATED_COLUMNS, copy_from_sql, copy_sql,
+                       has_donor_pk, query_selection_sql)
+
+PK_LOOKUPS = ('exact', 'in')
+FAN_OUT_CHUNK_SIZE = 500
+KEYSET_PAGE_SIZE = 20
+STREAM_FETCH_SIZE = 2000
+DONOR_OBJECT = 'donor_object'
+COPY_FORMATS = ('csv', 'text', 'binary')
+COPY_SPOOL_SIZE = 8 * 1024 * 1024 # bytes of each donor's COPY output kept in memory before spilling to disk
+COPY_CHUNK_SIZE = 64 * 1024
+# Postgres' binary COPY output starts with a signature, flags and an (empty) header extension, and ends with a -1
+BINARY_COPY_HEADER_SIZE = 19
+BINARY_COPY_TRAILER_SIZE = 2
+BINARY_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+BINARY_COPY_NULL = struct.pack('>i', -1) # the length of a NULL field
+# How binary COPY input spells the values of fields of these internal types, other than text ones
+BINARY_COPY_STRUCTS = {
+    'SmallIntegerField': '>h', 'PositiveSmallIntegerField': '>h', 'IntegerField': '>i', 'PositiveIntegerField': '>i',
+    'BigIntegerField': '>q', 'FloatField': '>d', 'BooleanField': '?', 'NullBooleanField': '?',
+}
+TEXT_COPY_NULL = '\\N'
+TEXT_COPY_END = '\\.'
+
+
+class CombinedSelection(BaseTable):
+    """Stands in for the view in a query's FROM clause, with a union over only some of its donors."""
+
+    def __init__(self, table_name, alias, selection, params=()):
+        super(CombinedSelection, self).__init__(table_name, alias)
+        self.selection = selection
+        self.params = tuple(params)
+
+    def as_sql(self, compiler, connection):
+        return '({}) {}'.format(self.selection, compiler.quote_name_unless_alias(self.table_alias)), list(self.params)
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(self.table_name, change_map.get(self.table_alias, self.table_alias),
+                              self.selection, self.params)
+
+
+class KeysetCondition:
+    """Branch condition selecting the rows that come after a keyset cursor, in the order (key, donor, donor_pk).
+
+    Within a branch the donor is a constant, so the condition reduces to a comparison of the key alone (or of key and
+    pk, in the cursor's own donor) which the donor's indexes can serve. Without a cursor, it only excludes NULL keys."""
+
+    def __init__(self, field, descending, cursor=None):
+        self.field = field
+        self.descending = descending
+        self.cursor = cursor
+
+    def as_sql(self, combiner, position):
+        source = combiner.source_column(position, self.field.column)
+        if source is None:
+            return 'FALSE', []
+        if self.cursor is None:
+            return '{} IS NOT NULL'.format(source), []
+        key, cursor_position, donor_pk = self.cursor
+        after, after_or_equal = ('<', '<=') if self.descending else ('>', '>=')
+        if position == cursor_position:
+            branch = combiner.plan.branches[position]
+            pk_column = '{}.{}'.format(branch.db_table, branch.pk_column) if branch.joins else branch.pk_column
+            return '({}, {}) {} (%s, %s)'.format(source, pk_column, after), [key, donor_pk]
+        # every key-tied row of a later donor comes after the cursor, and none of an earlier one
+        comes_later = (position < cursor_position) if self.descending else (position > cursor_position)
+        return '{} {} %s'.format(source, after_or_equal if comes_later else after), [key]
+
+
+class ForeignKeyCondition:
+    """Branch condition restricting a foreign key of the view to some target pks, on the donor's own foreign key
+    column. Each branch can then find its rows, such as those of a reverse relation or a prefetch, with the donor's
+    index on that column, whatever Postgres makes of the same filter on the union."""
+
+    def __init__(self, field, values):
+        self.field = field
+        self.values = values
+
+    def as_sql(self, combiner, position):
+        source = combiner.source_column(position, self.field.column)
+        if source is None or not self.values:
+            return 'FALSE', []
+        return '{} IN ({})'.format(source, ', '.join(['%s'] * len(self.values))), list(self.values)
+
+
+class CombinedQuery(Query):
+    """Query for combined views.
+
+    Rewrites lookups on the view's text id into lookups on its (donor, donor_pk) columns, which Postgres can push down
+    into each branch of the union and answer from the donor's pk index.
+
+    Also works out from the filters which donors can contribute rows at all: those allowed by lookups on the donor
+    column, and those that map a column which a filter requires to be non-NULL. If that excludes some donors, the
+    view in the FROM clause is replaced by a union over just the remaining ones."""
+
+    def __init__(self, *args, **kwargs):
+        super(CombinedQuery, self).__init__(*args, **kwargs)
+        self.donor_positions = None # None means every donor
+        # Clauses pushed into each branch of the union: conditions (see KeysetCondition), an ordering of
+        # (view column, descending) pairs and a row limit
+        self.branch_conditions = ()
+        self.branch_ordering = ()
+        self.branch_limit = None
+        self.fetch_size = None # rows per fetch from a server-side cursor, see CombinedQuerySet.stream()
+
+    def clone(self, klass=None, memo=None, **kwargs):
+        obj = super(CombinedQuery, self).clone(klass=klass, memo=memo, **kwargs)
+        obj.donor_positions = self.donor_positions
+        obj.branch_conditions = self.branch_conditions
+        obj.branch_ordering = self.branch_ordering
+        obj.branch_limit = self.branch_limit
+        obj.fetch_size = self.fetch_size
+        return obj
+
+    def add_q(self, q_object):
+        if self._rewrites_pk_lookups():
+            q_object = self._rewrite_pk_lookups(q_object)
+        clause = super(CombinedQuery, self).add_q(q_object)
+        if self.prunes_donors():
+            self.restrict_donors(self._possible_donors(q_object))
+            self.branch_conditions += self._foreign_key_conditions(q_object)
+        return clause
+
+    def get_compiler(self, using=None, connection=None):
+        if self.prunes_donors():
+            self._install_selection()
+        compiler = super(CombinedQuery, self).get_compiler(using=using, connection=connection)
+        if self.fetch_size is not None:
+            compiler.execute_sql = fetching_in_chunks(compiler, self.fetch_size)
+        return compiler
+
+    def prunes_donors(self):
+        # materialized views and incremental tables are read as they are, their rows never come from the donors
+        combiner = getattr(self.model, '_combiner', None)
+        return combiner is not None and not (combiner.materialized or combiner.incremental)
+
+    def possible_donor_positions(self):
+        if self.donor_positions is None:
+            return frozenset(range(len(self.model._combiner.donor_models)))
+        return self.donor_positions
+
+    def restrict_donors(self, positions):
+        if positions is None:
+            return
+        # discriminator values that are no donor's position match no rows
+        positions = self.possible_donor_positions() & frozenset(positions)
+        self.donor_positions = positions
+        if not positions:
+            super(CombinedQuery, self).add_q(Q(pk__in=[]))
+
+    def _install_selection(self):
+        combiner = self.model._combiner
+        branch_ordering, branch_limit = self.branch_ordering, self.branch_limit
+        if not branch_ordering and branch_limit is None:
+            branch_ordering, branch_limit = self._top_n()
+        pushes_clauses = self.branch_conditions or branch_ordering or branch_limit is not None
+        every_donor = self.donor_positions is None or len(self.donor_positions) == len(combiner.donor_models)
+        if not self.donor_positions and not every_donor:
+            return # no donor can match, so the query never runs
+        projection = self._projection(branch_ordering)
+        if every_donor and not pushes_clauses and projection is None:
+            return # the view as it is will do
+
+        def branch_where(position):
+            conditions = [ condition.as_sql(combiner, position) for condition in self.branch_conditions ]
+            conditions = [ condition for condition in conditions if condition is not None ]
+            if not conditions:
+                return None
+            return (' AND '.join('({})'.format(sql) for sql, _ in conditions),
+                    [ param for _, params in conditions for param in params ])
+
+        selection, params = query_selection_sql(combiner.plan, only=self.donor_positions, branch_where=branch_where,
+                                                order_by=branch_ordering, limit=branch_limit, projection=projection)
+        alias = self.tables[0] if self.tables else self.get_initial_alias()
+        self.alias_map[alias] = CombinedSelection(self.model._meta.db_table, alias, selection, params)
+
+    def _projection(self, branch_ordering=()):
+        # The view columns the query reads, if it can be told that it reads only some of them, else None. Under UNION
+        # Postgres can't leave unread columns out of the branches itself, since they take part in the deduplication.
+        opts = self.model._meta
+        if self.extra or self.select_related or self.combinator or self.distinct_fields:
+            return None
+        # lookups on foreign key columns leave the joins they trimmed unreferenced in the alias map
+        if sum(1 for alias in self.alias_map if self.alias_refcount[alias]) > 1:
+            return None
+        alias = self.tables[0] if self.tables else self.get_initial_alias()
+        columns = { opts.pk.column }
+        if self.default_cols:
+            names, defer = self.deferred_loading
+            if defer and not names:
+                return None
+            if any(LOOKUP_SEP in name for name in names):
+                return None
+            columns.update(field.column for field in opts.concrete_fields if (field.name in names) != defer)
+        expressions = list(self.select) + [self.where] + list(self.annotations.values())
+        if isinstance(self.group_by, (list, tuple)):
+            expressions.extend(self.group_by)
+        ordering = self.order_by or (opts.ordering if self.default_ordering else ())
+        for order in ordering:
+            if not isinstance(order, str):
+                expressions.append(order)
+                continue
+            name = order.lstrip('-')
+            if order == '?' or name in self.annotations:
+                continue
+            try:
+                field = opts.pk if name == 'pk' else opts.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if not field.concrete:
+                return None
+            columns.add(field.column)
+        referenced = referenced_columns(expressions, alias)
+        if referenced is None:
+            return None
+        columns |= referenced
+        columns.update(column for column, _ in branch_ordering)
+        if columns >= { field.column for field in opts.concrete_fields }:
+            return None
+        return frozenset(columns)
+
+    def _top_n(self):
+        # For order_by(...)[:n], every branch can be cut down to its own first n rows in that order before the union.
+        # That only holds if nothing after the union drops or merges rows, and the ordering is on the view's columns.
+        # Returns the (view column, descending) ordering and the limit to push into the branches, if any.
+        if self.high_mark is None or self.where or self.distinct or self.group_by is not None or \
+                self.annotations or self.extra or self.combinator:
+            return (), None
+        ordering = self.order_by or (self.model._meta.ordering if self.default_ordering else ())
+        branch_ordering = []
+        for order in ordering:
+            if not isinstance(order, str) or order == '?' or LOOKUP_SEP in order:
+                return (), None
+            name = order.lstrip('-')
+            try:
+                field = self.model._meta.pk if name == 'pk' else self.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return (), None
+            if not field.concrete:
+                return (), None
+            branch_ordering.append((field.column, order.startswith('-')))
+        return tuple(branch_ordering), self.high_mark
+
+    def _possible_donors(self, q_object):
+        # The positions of the donors whose rows could satisfy q_object, or None if it doesn't rule any out
+        if q_object.negated or not q_object.children:
+            return None
+        results = [ self._possible_donors(child) if isinstance(child, Q) else self._possible_donors_for_lookup(*child)
+                    for child in q_object.children ]
+        if q_object.connector == Q.AND or len(results) == 1:
+            constraining = [ result for result in results if result is not None ]
+            if not constraining:
+                return None
+            return frozenset.intersection(*constraining)
+        if any(result is None for result in results):
+            return None
+        return frozenset.union(*results)
+
+    def _possible_donors_for_lookup(self, lookup, value):
+        combiner = self.model._combiner
+        parts = lookup.split(LOOKUP_SEP)
+        if len(parts) > 2:
+            return None
+        field_name, lookup_type = parts[0], (parts[1] if len(parts) == 2 else 'exact')
+        try:
+            field = self.model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            return None
+        if field.column == DISCRIMINATOR and combiner.union_all:
+            if lookup_type == 'exact':
+                value = [value]
+            elif lookup_type != 'in' or not isinstance(value, (list, tuple, set, frozenset)):
+                return None
+            try:
+                return frozenset(int(position) for position in value)
+            except (TypeError, ValueError):
+                return None
+        if field.primary_key or field.column in GENERATED_COLUMNS:
+            return None # every donor fills these
+        if (lookup_type == 'isnull' and value) or (lookup_type in ('exact', 'iexact') and value is None) or \
+                field.get_lookup(lookup_type) is None:
+            return None
+        # any other lookup fails on NULL, so donors that don't map the column can't match
+        return frozenset(position for position in range(len(combiner.donor_models))
+                         if combiner.source_column(position, field.column) is not None)
+
+    def _foreign_key_conditions(self, q_object):
+        # A ForeignKeyCondition for each lookup of a foreign key on target pks that every row must match, which is
+        # then both pushed into the branches and left in the WHERE clause
+        if q_object.negated or (q_object.connector != Q.AND and len(q_object.children) > 1):
+            return ()
+        conditions = ()
+        for child in q_object.children:
+            if isinstance(child, Q):
+                conditions += self._foreign_key_conditions(child)
+            else:
+                condition = self._foreign_key_condition(*child)
+                if condition is not None:
+                    conditions += (condition,)
+        return conditions
+
+    def _foreign_key_condition(self, lookup, value):
+        parts = lookup.split(LOOKUP_SEP)
+        try:
+            field = self.model._meta.get_field(parts[0])
+        except FieldDoesNotExist:
+            return None
+        if not field.many_to_one:
+            return None
+        if parts[1:2] and parts[1] in ('pk', field.target_field.name) and parts[0] == field.name:
+            parts = parts[:1] + parts[2:]
+        lookup_type = parts[1] if len(parts) == 2 else 'exact' if len(parts) == 1 else None
+        if lookup_type == 'exact':
+            values = [value]
+        elif lookup_type == 'in' and isinstance(value, (list, tuple, set, frozenset)):
+            values = list(value)
+        else: # subqueries and other lookups are left to the database
+            return None
+        target = field.target_field
+        column_type = target
+        while column_type.remote_field is not None: # a multi-table inheritance pk, typed by the parent's
+            column_type = column_type.target_field
+        pks = []
+        for value in values:
+            if isinstance(value, Model):
+                value = getattr(value, target.attname)
+            if value is None or hasattr(value, 'resolve_expression'):
+                return None
+            pks.append(column_type.get_prep_value(value))
+        return ForeignKeyCondition(field, pks)
+
+    def _rewrites_pk_lookups(self):
+        combiner = getattr(self.model, '_combiner', None)
+        return combiner is not None and combiner.union_all and has_donor_pk(self.model)
+
+    def _rewrite_pk_lookups(self, q_object):
+        rewritten = Q()
+        rewritten.connector = q_object.connector
+        rewritten.negated = q_object.negated
+        for child in q_object.children:
+            if isinstance(child, Q):
+                rewritten.children.append(self._rewrite_pk_lookups(child))
+            else:
+                rewritten.children.append(self._rewrite_pk_lookup(*child))
+        return rewritten
+
+    def _rewrite_pk_lookup(self, lookup, value):
+        field_name, _, lookup_type = lookup.partition('__')
+        lookup_type = lookup_type or 'exact'
+        if field_name not in ('pk', self.model._meta.pk.name) or lookup_type not in PK_LOOKUPS:
+            return (lookup, value)
+        if lookup_type == 'exact':
+            values = [value]
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            values = value
+        else: # subqueries and expressions are left to the database
+            return (lookup, value)
+
+        pks_by_donor = {}
+        unsplittable = []
+        for view_id in values:
+            if isinstance(view_id, self.model):
+                view_id = view_id.pk
+            split = self.model._combiner.split_id(view_id) if isinstance(view_id, str) else None
+            if split is None:
+                unsplittable.append(view_id)
+            else:
+                pks_by_donor.setdefault(split[0], []).append(split[1])
+
+        rewritten = Q()
+        rewritten.connector = Q.OR
+        for index in sorted(pks_by_donor):
+            pks = pks_by_donor[index]
+            if len(pks) == 1:
+                rewritten.children.append(Q(**{DISCRIMINATOR: index, DONOR_PK: pks[0]}))
+            else:
+                rewritten.children.append(Q(**{DISCRIMINATOR: index, DONOR_PK + '__in': pks}))
+        if unsplittable:
+            # values that aren't the id of any donor row are still compared against the text id, as before
+            rewritten.children.append(Q(**{'pk__in': unsplittable}))
+        if not rewritten.children:
+            return Q(pk__in=[])
+        return rewritten
+
+
+class CombinedQuerySet(QuerySet):
+    def __init__(self, model=None, query=None, using=None, hints=None):
+        query = query or CombinedQuery(model)
+        super(CombinedQuerySet, self).__init__(model=model, query=query, using=using, hints=hints)
+        self._donor_prefetch = None # None, or whether to prefetch each donor on its own connection
+        self._view_cache = None # the manager's combine.cache.ResultCache, if any
+
+    def _clone(self, **kwargs):
+        clone = super(CombinedQuerySet, self)._clone(**kwargs)
+        clone._donor_prefetch = kwargs.get('_donor_prefetch', self._donor_prefetch)
+        clone._view_cache = kwargs.get('_view_cache', self._view_cache)
+        return clone
+
+    def _fetch_all(self):
+        prefetch = self._result_cache is None and self._donor_prefetch is not None
+        if self._result_cache is None and self._view_cache is not None and not self.query.select_for_update:
+            self._result_cache = self._view_cache.fetch(self, self._fetch_results)
+        elif self._result_cache is None and self._groups_by_donor():
+            self._result_cache = self._grouped_by_donor()
+        super(CombinedQuerySet, self)._fetch_all()
+        if prefetch and self._iterable_class is ModelIterable:
+            resolve_donors(self._result_cache, self.db, parallel=self._donor_prefetch)
+
+    def _fetch_results(self):
+        if self._groups_by_donor():
+            return self._grouped_by_donor()
+        return list(self._iterable_class(self))
+
+    def uncached(self):
+        """Reads the results from the database even if the manager caches them."""
+        return self._clone(_view_cache=None)
+
+    def iterator(self):
+        if self._groups_by_donor():
+            return iter(self._grouped_by_donor())
+        return super(CombinedQuerySet, self).iterator()
+
+    def aggregate(self, *args, **kwargs):
+        """Like QuerySet.aggregate(), but Sum, Count, Min, Max and Avg over the view's own fields are computed for each
+        donor separately, as partial aggregates that are combined afterwards, rather than over the whole union. Each
+        donor's query can then aggregate its table directly, using its indexes."""
+        aggregates = OrderedDict()
+        for arg in args:
+            try:
+                aggregates[arg.default_alias] = arg
+            except (AttributeError, TypeError):
+                return super(CombinedQuerySet, self).aggregate(*args, **kwargs)
+        aggregates.update(kwargs)
+        resolved = self.query.clone()
+        for alias, aggregate in aggregates.items():
+            resolved.add_annotation(aggregate, alias, is_summary=True)
+        split = self._split_aggregates(resolved.annotations) if self._aggregates_by_donor() else None
+        if split is None:
+            return super(CombinedQuerySet, self).aggregate(*args, **kwargs)
+
+        partials, combiners = split
+        results = []
+        for position in sorted(self.query.possible_donor_positions()):
+            branch = self._clone()
+            branch.query.restrict_donors(frozenset([position]))
+            results.append(branch.aggregate(**partials))
+        return OrderedDict([ (alias, combine([ [ result[name] for name in names ] for result in results ]))
+                             for alias, (combine, names) in combiners.items() ])
+
+    def _aggregates_by_donor(self):
+        # Whether the query's rows can be aggregated for each donor separately, and there is more than one donor
+        query = self.query
+        return query.prunes_donors() and len(query.possible_donor_positions()) > 1 and not query.annotations and \
+            not query.distinct and not query.extra and not query.combinator and \
+            query.low_mark == 0 and query.high_mark is None
+
+    def _groups_by_donor(self):
+        # Whether this is a values(...).annotate(aggregates) query whose groups can be aggregated for each donor
+        # separately, and combined and ordered afterwards
+        query = self.query
+        if not (self._iterable_class is ValuesIterable and isinstance(query.group_by, (list, tuple)) and
+                query.prunes_donors() and len(query.possible_donor_positions()) > 1):
+            return False
+        if query.distinct or query.extra or query.combinator or query.where.contains_aggregate or \
+                not query.annotations or len(query.annotation_select) != len(query.annotations) or \
+                not all(name in query.values_select for name in self._fields):
+            return False
+        if not query.order_by and query.default_ordering and self.model._meta.ordering:
+            return False # Django adds the default ordering to the GROUP BY
+        names = list(query.values_select) + list(query.annotations)
+        if query.extra_order_by or not all(isinstance(order, str) and order.lstrip('-') in names
+                                           for order in query.order_by):
+            return False
+        # The groups are ordered in Python, which can't compare strings by the database's collation
+        for order in query.order_by:
+            name = order.lstrip('-')
+            if name in query.values_select:
+                try:
+                    field = self.model._meta.pk if name == 'pk' else self.model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    return False
+                if collates(field):
+                    return False
+        return self._split_aggregates(query.annotations) is not None
+
+    def _grouped_by_donor(self):
+        partials, combiners = self._split_aggregates(self.query.annotations)
+        group_names = list(self.query.values_select)
+        groups = OrderedDict()
+        for position in sorted(self.query.possible_donor_positions()):
+            branch = self._clone()
+            query = branch.query
+            query.restrict_donors(frozenset([position]))
+            query.annotations.clear()
+            query.set_annotation_mask(None)
+            query.group_by = None
+            query.clear_ordering(force_empty=True)
+            query.clear_limits()
+            for row in branch.annotate(**partials):
+                key = tuple([ row[name] for name in group_names ])
+                groups.setdefault(key, []).append(row)
+
+        rows = []
+        for key, results in groups.items():
+            row = OrderedDict(zip(group_names, key))
+            for alias, (combine, names) in combiners.items():
+                row[alias] = combine([ [ result[name] for name in names ] for result in results ])
+            rows.append(dict(row))
+        for order in reversed(self.query.order_by):
+            name = order.lstrip('-')
+            rows.sort(key=lambda row: nulls_last(row[name]), reverse=order.startswith('-'))
+        return rows[self.query.low_mark:self.query.high_mark]
+
+    def _split_aggregates(self, aggregates):
+        # Splits each of the (resolved) aggregates into partial aggregates over the view's own fields that can be
+        # computed for each donor separately. Returns the partial aggregates by name, and for each aggregate the
+        # function combining the values of its partials and their names; or None if any of them can't be split.
+        partials = OrderedDict()
+        combiners = OrderedDict()
+        for alias, aggregate in aggregates.items():
+            if type(aggregate) not in PARTIAL_AGGREGATES or aggregate.extra.get('distinct'):
+                return None
+            sources = aggregate.get_source_expressions()
+            if len(sources) != 1:
+                return None
+            if isinstance(sources[0], Star):
+                source = '*'
+            elif isinstance(sources[0], Col) and sources[0].alias == self.model._meta.db_table and \
+                    sources[0].target.model is self.model:
+                source = sources[0].target.name
+            else:
+                return None
+            # The partial minimums and maximums are compared in Python, which doesn't follow the collation
+            if type(aggregate) in (Min, Max) and source != '*' and collates(sources[0].target):
+                return None
+            functions, combine = PARTIAL_AGGREGATES[type(aggregate)]
+            names = []
+            for function in functions:
+                name = 'partial_{}'.format(len(partials))
+                partials[name] = function(source)
+                names.append(name)
+            combiners[alias] = (combine, names)
+        return partials, combiners
+
+    def count_by_donor(self, parallel=True):
+        """Returns the number of results from each donor, as an OrderedDict from donor model to count in the order of
+        Combiner.donors, with a COUNT(*) query per donor that can match. The queries run on their own threads and
+        database connections if parallel, so they don't see changes made in an open transaction."""
+        combiner = self.model._combiner
+        counts = OrderedDict([ (donor, 0) for donor in combiner.donor_models ])
+        if not self.query.prunes_donors():
+            if not combiner.union_all:
+                raise TypeError("Counting by donor needs a UNION ALL view or one that reads from its donors")
+            for row in self.order_by().values(DISCRIMINATOR).annotate(count=Count('*')):
+                counts[combiner.donor_models[row[DISCRIMINATOR]]] = row['count']
+            return counts
+
+        positions = sorted(self.query.possible_donor_positions())
+        branches = []
+        for position in positions:
+            branch = self._clone()
+            branch.query.restrict_donors(frozenset([position]))
+            branches.append(branch)
+        count = lambda branch: branch.count()
+        found = parallel_map(count, branches, self.db) if parallel and len(branches) > 1 else map(count, branches)
+        for position, donor_count in zip(positions, found):
+            counts[combiner.donor_models[position]] = donor_count
+        return counts
+
+    def count_fast(self, parallel=True):
+        """The exact number of results, as the sum of a COUNT(*) query per donor (see count_by_donor())."""
+        if self._result_cache is not None or not self.query.prunes_donors():
+            return self.count()
+        return sum(self.count_by_donor(parallel).values())
+
+    def estimated_count(self, by_donor=False):
+        """The number of rows Postgres' statistics estimate the donor tables that can match have, with no query on
+        the tables themselves. Filters that don't rule out whole donors are ignored. If by_donor, returns an
+        OrderedDict from donor model to its estimate instead."""
+        combiner = self.model._combiner
+        if not self.query.prunes_donors():
+            if by_donor:
+                raise TypeError("A materialized view or incremental table has no estimates by donor")
+            return sum(estimated_rows([self.model._meta.db_table], self.db).values())
+
+        positions = self.query.possible_donor_positions()
+        tables = [ donor._meta.db_table for position, donor in enumerate(combiner.donor_models)
+                   if position in positions ]
+        estimates = estimated_rows(tables, self.db)
+        counts = OrderedDict([ (donor, estimates.get(donor._meta.db_table, 0)) for donor in combiner.donor_models ])
+        return counts if by_donor else sum(counts.values())
+
+    def prefetch_donors(self, parallel=False):
+        """Sets each result's donor_object to the donor model instance its row came from, when the results are
+        fetched. Runs one pk__in query per donor, each on its own thread and database connection if parallel."""
+        return self._clone(_donor_prefetch=parallel)
+
+    def resolve_donors(self, parallel=False):
+        """Returns the donor model instances the results' rows came from, in order, with one query per donor."""
+        if self._iterable_class is not ModelIterable:
+            raise TypeError("resolve_donors() needs model instances, not values")
+        return [ getattr(row, DONOR_OBJECT) for row in self.prefetch_donors(parallel) ]
+
+    def fan_out(self, chunk_size=FAN_OUT_CHUNK_SIZE):
+        """Iterates over the results by running one query per donor, each on its own thread and database connection,
+        and lazily merging their results in the queryset's order. Slices are applied to each donor's query and again
+        to the merged results. Ordering may only use the view's own fields, and not text ones, which Postgres orders
+        by a collation that Python can't reproduce.
+
+        The threads use fresh connections, so they don't see changes made in an open transaction."""
+        if self._result_cache is not None or not self.query.prunes_donors():
+            for item in (self._result_cache if self._result_cache is not None else self.iterator()):
+                yield item
+            return
+
+        low_mark, high_mark = self.query.low_mark, self.query.high_mark
+        merge_key = self._merge_key()
+        branches = []
+        for position in sorted(self.query.possible_donor_positions()):
+            branch = self._clone()
+            branch.query.restrict_donors(frozenset([position]))
+            branch.query.clear_limits()
+            branch.query.set_limits(high=high_mark)
+            branches.append(branch)
+
+        streams = parallel_streams([ branch.iterator for branch in branches ], self.db, chunk_size=chunk_size)
+        try:
+            merged = heapq.merge(*streams, key=merge_key) if merge_key else chain.from_iterable(streams)
+            for item in islice(merged, low_mark, high_mark):
+                yield item
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def stream(self, fetch_size=STREAM_FETCH_SIZE, tuples=False):
+        """Iterates over the results without caching them, reading fetch_size rows at a time from a server-side
+        (named) cursor on Postgres, so memory use doesn't grow with the size of the view. Yields tuples of the
+        view's field values instead of model instances if tuples.
+
+        Outside a transaction the cursor is held open across commits until the iteration ends."""
+        queryset = self.values_list() if tuples else self._clone()
+        queryset.query.fetch_size = fetch_size
+        chunked_fetch = not connections[self.db].settings_dict.get('DISABLE_SERVER_SIDE_CURSORS')
+        return iter(queryset._iterable_class(queryset, chunked_fetch=chunked_fetch))
+
+    def copy_to(self, file, format='csv', header=True, parallel=False):
+        """Writes the results to file with Postgres' COPY (SELECT ...) TO STDOUT, without creating any model instances,
+        in 'csv' (with a header row, if header), 'text' or 'binary' format. Returns the number of rows written.
+
+        If parallel, runs one COPY per donor that can match instead, each on its own thread and database connection,
+        and writes their outputs one donor after the other. The queryset's ordering then holds within each donor's rows
+        only, and the threads don't see changes made in an open transaction."""
+        if format not in COPY_FORMATS:
+            raise ValueError("COPY format must be one of {}, not {!r}".format(', '.join(COPY_FORMATS), format))
+        branches = [self]
+        if parallel and self.query.prunes_donors():
+            branches = []
+            for position in sorted(self.query.possible_donor_positions()):
+                branch = self._clone()
+                branch.query.restrict_donors(frozenset([position]))
+                branches.append(branch)
+        sqls = [ branch._copy_sql(format, header and format == 'csv' and index == 0)
+                 for index, branch in enumerate(branches) ]
+        sqls = [ sql for sql in sqls if sql is not None ]
+        if len(sqls) == 1:
+            with connections[self.db].cursor() as cursor:
+                cursor.copy_expert(sqls[0], file)
+                return cursor.rowcount
+
+        def copy(sql):
+            spool = SpooledTemporaryFile(max_size=COPY_SPOOL_SIZE)
+            with connections[self.db].cursor() as cursor:
+                cursor.copy_expert(sql, spool)
+                return spool, cursor.rowcount
+        outputs = parallel_map(copy, sqls, self.db)
+        concatenate_copies([ spool for spool, _ in outputs ], file, binary=format == 'binary')
+        return sum(rows for _, rows in outputs)
+
+    def _copy_sql(self, format, header):
+        # None if the queryset can't have any results
+        try:
+            sql, params = self.query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            return None
+        with connections[self.db].cursor() as cursor:
+            query = cursor.mogrify(sql, params).decode('utf-8')
+        return copy_sql(query, format, header)
+
+    def copy_from(self, file, format='csv', header=True, columns=None, parallel=False):
+        """Loads rows laid out like the view's from file, in COPY 'csv', 'text' or 'binary' format, into the donor
+        tables with COPY ... FROM STDIN. columns names the view field of each of the input's columns; it defaults to
+        the csv header row, if header, or else to all of the view's fields in order, as copy_to() writes them. Returns
+        the number of rows loaded.
+
+        The rows are split by their discriminator in one pass over the input, and each donor's are then loaded with
+        one COPY into the donor fields that feed the view's fields. The donor's other fields get their defaults, which
+        binary input can only spell for text, integer, float and boolean fields. The id and donor_pk columns are
+        ignored. In csv input, empty values are NULL in nullable donor columns and empty strings in the others. If
+        parallel, the donors' COPYs run on their own threads and database connections, and so in separate
+        transactions; otherwise they run in one transaction. Multi-table inherited donors, whose rows span several
+        tables, can't be loaded."""
+        spools, sqls = self._spool_by_donor(file, format, header, columns)
+        donors = self.model._combiner.donor_models
+
+        def copy(position):
+            spools[position].seek(0)
+            with connections[self.db].cursor() as cursor:
+                cursor.copy_expert(sqls[position], spools[position])
+                return cursor.rowcount
+        try:
+            if parallel and len(spools) > 1:
+                counts = parallel_map(copy, list(spools), self.db)
+            else:
+                with transaction.atomic(using=self.db):
+                    counts = [ copy(position) for position in spools ]
+        finally:
+            for spool in spools.values():
+                spool.close()
+        for position in spools:
+            invalidate(donors[position], using=self.db)
+        return sum(counts)
+
+    def _spool_by_donor(self, file, format, header, columns):
+        # Each donor's rows of the input, in a spool ready for its COPY, and that COPY, by the donor's position
+        combiner = self.model._combiner
+        if format not in COPY_FORMATS:
+            raise ValueError("COPY format must be one of {}, not {!r}".format(', '.join(COPY_FORMATS), format))
+        if not combiner.union_all:
+            raise TypeError("copy_from() needs the '{}' field of a UNION ALL view".format(DISCRIMINATOR))
+        for position, donor in enumerate(combiner.donor_models):
+            # A COPY fills one table, and a multi-table inherited donor's rows span its parents' too
+            if donor._meta.parents or any(donor_field is not None and donor_field.model._meta.concrete_model
+                                          is not donor._meta.concrete_model
+                                          for _, donor_field in combiner.donor_fields(position)):
+                raise TypeError("copy_from() can't load {} rows: {} is a multi-table inherited model".format(
+                    self.model.__name__, donor.__name__))
+        if format == 'binary':
+            rows = binary_copy_rows(file)
+            null = BINARY_COPY_NULL
+        else:
+            if not isinstance(file, io.TextIOBase):
+                file = io.TextIOWrapper(file, encoding='utf-8', newline='')
+            rows = csv.reader(file) if format == 'csv' else text_copy_rows(file)
+            null = '' if format == 'csv' else TEXT_COPY_NULL
+            if header and format == 'csv':
+                header_row = next(rows, None)
+                columns = columns or header_row
+        fields = [ self.model._meta.get_field(name) for name in columns or [] ] or self.model._meta.concrete_fields
+        try:
+            discriminator = [ field.column for field in fields ].index(DISCRIMINATOR)
+        except ValueError:
+            raise ValueError("copy_from() needs a '{}' column to route rows by".format(DISCRIMINATOR))
+
+        connection = connections[self.db]
+        layouts = []
+        for position, donor in enumerate(combiner.donor_models):
+            renamed = dict(combiner.donor_fields(position))
+            copied, dropped = [], []
+            for index, field in enumerate(fields):
+                if field in renamed and renamed[field] is not None:
+                    copied.append((index, renamed[field]))
+                elif field in renamed:
+                    dropped.append((index, field))
+            # Donor fields that no column of the input feeds get their defaults, as saving a donor instance would
+            loaded = { donor_field for _, donor_field in copied }
+            filled, unfillable = [], None
+            for field in donor._meta.concrete_fields:
+                if field in loaded or isinstance(field, AutoField) or (field.null and not field.has_default()):
+                    continue
+                if format == 'binary' and not (collates(field) or field.get_internal_type() in BINARY_COPY_STRUCTS):
+                    unfillable = "binary input can't spell the default of {}.{}; use csv or text".format(
+                        donor.__name__, field.name)
+                elif not field.has_default() and field.get_default() is None:
+                    unfillable = "{}.{} has no default, and no column of the input feeds it".format(
+                        donor.__name__, field.name)
+                else:
+                    filled.append((field, copy_default(field, format, connection)))
+            layouts.append((copied, dropped, filled, unfillable))
+
+        spools = OrderedDict()
+        writers = {}
+        for line, row in enumerate(rows, 1):
+            position = copy_position(row[discriminator], format)
+            if position is None:
+                raise ValueError("Row {} of the input has no valid {}".format(line, DISCRIMINATOR))
+            if not 0 <= position < len(layouts):
+                raise ValueError("Row {} of the input has no donor at position {}".format(line, position))
+            copied, dropped, filled, unfillable = layouts[position]
+            for index, field in dropped:
+                if row[index] != null:
+                    raise ValueError("Row {} of the input has a value for {}.{}, which {} has no field for".format(
+                        line, self.model.__name__, field.name, combiner.donor_models[position].__name__))
+            if position not in spools:
+                if unfillable:
+                    raise ValueError("Row {} of the input can't be loaded: {}".format(line, unfillable))
+                spools[position] = SpooledTemporaryFile(max_size=COPY_SPOOL_SIZE, mode='w+b' if format == 'binary'
+                                                        else 'w+', newline=None if format == 'binary' else '')
+                writers[position] = copy_row_writer(spools[position], format)
+            writers[position]([ row[index] for index, _ in copied ] + [ default() for _, default in filled ])
+        if format == 'binary':
+            for spool in spools.values():
+                spool.write(struct.pack('>h', -1))
+
+        sqls = {}
+        for position in spools:
+            copied, _, filled, _ = layouts[position]
+            copied = [ donor_field for _, donor_field in copied ] + [ field for field, _ in filled ]
+            sqls[position] = copy_from_sql(combiner.donor_models[position]._meta.db_table,
+                                           [ field.column for field in copied ], format,
+                                           not_null=[ field.column for field in copied if not field.null ])
+        return spools, sqls
+
+    def keyset_page(self, order_key, cursor=None, page_size=KEYSET_PAGE_SIZE):
+        """Returns the page of up to page_size results that follows cursor (None for the first page) in the order of
+        order_key (a field name, prefixed with '-' for descending order), and the cursor for the next page, or None if
+        this was the last one. Rows whose order key is NULL are skipped. Needs a UNION ALL view with a donor_pk column.
+
+        The page's condition, ordering and limit are pushed into every branch of the union, so each donor only reads
+        the next page_size rows from an index on the order key, however deep the page."""
+        if not (self.model._combiner.union_all and has_donor_pk(self.model)):
+            raise TypeError("Keyset pagination needs a UNION ALL view with a {} column".format(DONOR_PK))
+        descending = order_key.startswith('-')
+        field = self.model._meta.get_field(order_key.lstrip('-'))
+        pushes_limit = not self.query.where
+
+        queryset = self.filter(**{field.name + '__isnull': False})
+        if cursor is not None:
+            cursor = decode_cursor(cursor, field)
+            key, position, donor_pk = cursor
+            after = '__lt' if descending else '__gt'
+            queryset = queryset.filter(Q(**{field.name + after: key}) |
+                                       Q(**{field.name: key, DISCRIMINATOR + after: position}) |
+                                       Q(**{field.name: key, DISCRIMINATOR: position, DONOR_PK + after: donor_pk}))
+        prefix = '-' if descending else ''
+        queryset = queryset.order_by(prefix + field.name, prefix + DISCRIMINATOR, prefix + DONOR_PK)
+        if queryset.query.prunes_donors():
+            queryset.query.branch_conditions += (KeysetCondition(field, descending, cursor),)
+            if pushes_limit: # other filters apply after the union, so could leave a branch short of rows
+                queryset.query.branch_ordering = ((field.column, descending), (DONOR_PK, descending))
+                queryset.query.branch_limit = page_size
+
+        rows = list(queryset[:page_size])
+        if len(rows) < page_size:
+            return rows, None
+        last = rows[-1]
+        if isinstance(last, dict):
+            key = last[field.name] if field.name in last else last[field.attname]
+            return rows, encode_cursor(key, last[DISCRIMINATOR], last[DONOR_PK])
+        return rows, encode_cursor(getattr(last, field.attname), getattr(last, DISCRIMINATOR), getattr(last, DONOR_PK))
+
+    def bulk_create(self, objs, batch_size=None):
+        """Saves the objs, unsaved view instances, as rows of their donors: those of each donor with one bulk_create(),
+        all in one transaction. Each obj's donor is the one at the position in its discriminator, and its fields are
+        saved to the donor fields that feed them. Sets the objs' ids, and donor_pk, if the database returns the new
+        rows' pks, as Postgres does. Like QuerySet.bulk_create(), it can't save rows of multi-table inherited donors."""
+        combiner = self.model._combiner
+        if not combiner.union_all:
+            raise TypeError("bulk_create() needs the '{}' field of a UNION ALL view".format(DISCRIMINATOR))
+        by_position = OrderedDict()
+        for obj in objs:
+            position = getattr(obj, DISCRIMINATOR)
+            if position is None or not 0 <= position < len(combiner.donor_models):
+                raise ValueError("{!r} has no donor at position {!r}".format(obj, position))
+            by_position.setdefault(position, []).append(obj)
+        for position in by_position:
+            donor = combiner.donor_models[position]
+            if donor._meta.parents:
+                raise TypeError("bulk_create() can't save {} rows: Django can't bulk create {}, a multi-table "
+                                "inherited model".format(self.model.__name__, donor.__name__))
+        with transaction.atomic(using=self.db, savepoint=False):
+            for position, view_objs in sorted(by_position.items()):
+                donor = combiner.donor_models[position]
+                fields = combiner.donor_fields(position)
+                donor_objs = [ donor(**self._donor_values(donor, fields, obj)) for obj in view_objs ]
+                donor._default_manager.using(self.db).bulk_create(donor_objs, batch_size=batch_size)
+                for obj, donor_obj in zip(view_objs, donor_objs):
+                    if donor_obj.pk is not None:
+                        obj.pk = '{}.{}'.format(donor._meta.db_table, donor_obj.pk)
+                        if has_donor_pk(self.model):
+                            setattr(obj, DONOR_PK, donor_obj.pk)
+                    obj._state.adding = False
+                    obj._state.db = self.db
+                invalidate(donor, using=self.db)
+        return objs
+
+    def _donor_values(self, donor, fields, obj):
+        values = {}
+        for field, donor_field in fields:
+            value = getattr(obj, field.attname)
+            if donor_field is not None:
+                values[donor_field.attname] = value
+            elif value is not None:
+                raise ValueError("{} has no field for {}.{}".format(donor.__name__, self.model.__name__, field.name))
+        return values
+
+    def update(self, **kwargs):
+        """Updates the rows of each donor that the queryset includes, with one UPDATE per donor and all in one
+        transaction, setting the donor fields that feed the given view fields. F() expressions, including those inside
+        other expressions, may name view fields. Returns the number of rows updated."""
+        assert self.query.can_filter(), "Cannot update a query once a slice has been taken."
+        combiner = self.model._combiner
+        rows = 0
+        with transaction.atomic(using=self.db, savepoint=False):
+            for position, donor_queryset in self._donor_querysets():
+                donor = combiner.donor_models[position]
+                renamed = { field.name: donor_field for field, donor_field in combiner.donor_fields(position) }
+                values = { self._donor_field_name(donor, renamed, name): self._donor_expression(donor, renamed, value)
+                           for name, value in kwargs.items() }
+                rows += donor_queryset.update(**values)
+                invalidate(donor, using=self.db)
+        self._result_cache = None
+        return rows
+
+    def _donor_expression(self, donor, renamed, value):
+        # The value with the F()s in it, however deep, naming the donor fields that feed the view fields they name
+        if isinstance(value, F):
+            return F(self._donor_field_name(donor, renamed, value.name))
+        if not hasattr(value, 'get_source_expressions'):
+            return value
+        value = value.copy()
+        value.set_source_expressions([ self._donor_expression(donor, renamed, source)
+                                       for source in value.get_source_expressions() ])
+        return value
+
+    def _donor_field_name(self, donor, renamed, name):
+        donor_field = renamed.get(self.model._meta.get_field(name).name)
+        if donor_field is None:
+            raise ValueError("{} has no field for {}.{}".format(donor.__name__, self.model.__name__, name))
+        return donor_field.name
+
+    def delete(self):
+        """Deletes the rows of each donor that the queryset includes, through the donors' own delete(), so that
+        cascades and signals work as usual, all in one transaction. Returns the number of objects deleted and a
+        dictionary of the number deleted per model, like QuerySet.delete()."""
+        assert self.query.can_filter(), "Cannot use 'limit' or 'offset' with delete."
+        if self._fields is not None:
+            raise TypeError("Cannot call delete() after .values() or .values_list()")
+        deleted = 0
+        per_model = {}
+        with transaction.atomic(using=self.db, savepoint=False):
+            for position, donor_queryset in self._donor_querysets():
+                count, counts = donor_queryset.delete()
+                deleted += count
+                for label, model_count in counts.items():
+                    per_model[label] = per_model.get(label, 0) + model_count
+        self._result_cache = None
+        return deleted, per_model
+
+    def _donor_querysets(self):
+        # The position of each donor that can have rows in the queryset, and a queryset of those rows of its table
+        combiner = self.model._combiner
+        positions = sorted(self.query.possible_donor_positions())
+        if has_donor_pk(self.model):
+            # The view's rows are looked up in a subquery, rather than fetched first
+            for position in positions:
+                donor_pks = self.filter(**{ DISCRIMINATOR: position }).order_by().values(DONOR_PK)
+                yield position, combiner.donor_models[position]._default_manager.using(self.db).filter(pk__in=donor_pks)
+            return
+        pks = OrderedDict([ (position, []) for position in positions ])
+        for view_id in self.order_by().values_list('pk', flat=True):
+            split = combiner.split_id(view_id)
+            if split is not None and split[0] in pks:
+                pks[split[0]].append(split[1])
+        for position, donor_pks in pks.items():
+            if donor_pks:
+                yield position, combiner.donor_models[position]._default_manager.using(self.db).filter(pk__in=donor_pks)
+
+    def _merge_key(self):
+        # A sort key reproducing the queryset's ordering on the items it yields, or None if it is unordered
+        if self.query.order_by:
+            ordering = self.query.order_by
+        elif self.query.default_ordering:
+            ordering = self.model._meta.ordering
+        else:
+            ordering = ()
+        if not ordering:
+            return None
+
+        if self._iterable_class is ModelIterable:
+            value_names = None
+        else:
+            value_names = list(self._fields) or [ field.attname for field in self.model._meta.concrete_fields ]
+        getters = []
+        for order in ordering:
+            if not isinstance(order, str) or order == '?':
+                raise ValueError("fan_out() can only merge on fields, not {!r}".format(order))
+            descending = order.startswith('-')
+            name = order.lstrip('-')
+            field = self.model._meta.pk if name == 'pk' else self.model._meta.get_field(name)
+            if collates(field):
+                raise ValueError("fan_out() can't merge on {}, whose values Postgres orders by a collation"
+                                 .format(field.name))
+            getters.append((self._item_getter(field, value_names), descending))
+
+        def merge_key(item):
+            key = []
+            for getter, descending in getters:
+                value = nulls_last(getter(item))
+                key.append(Descending(value) if descending else value)
+            return key
+        return merge_key
+
+    def _item_getter(self, field, value_names):
+        if value_names is None:
+            return attrgetter(field.attname)
+        for name in (field.name, field.attname):
+            if name in value_names:
+                if self._iterable_class is ValuesIterable:
+                    return itemgetter(name)
+                if self._iterable_class is FlatValuesListIterable:
+                    return lambda value: value
+                return itemgetter(value_names.index(name))
+        raise ValueError("fan_out() can only merge on ordering fields that are selected, not {}".format(field.name))
+
+
+def referenced_columns(expressions, alias):
+    """The columns of the table alias that the expressions, lookups and where nodes refer to, or None if they hold
+    SQL or subqueries whose columns can't be told."""
+    columns = set()
+    pending = list(expressions)
+    while pending:
+        expression = pending.pop()
+        if isinstance(expression, Col):
+            if expression.alias == alias:
+                columns.add(expression.target.column)
+        elif isinstance(expression, WhereNode):
+            pending.extend(expression.children)
+        elif isinstance(expression, (Query, QuerySet, RawSQL, Subquery, ExtraWhere, SubqueryConstraint)):
+            return None
+        elif hasattr(expression, 'get_source_expressions'):
+            pending.extend(expression.get_source_expressions())
+        elif expression is not None and not isinstance(expression, NothingNode):
+            return None
+    return columns
+
+
+def fetching_in_chunks(compiler, fetch_size):
+    # Replaces a compiler's execute_sql with one reading multiple rows fetch_size at a time, not Django's fixed 100
+    execute_sql = compiler.execute_sql
+
+    def fetch_in_chunks(cursor):
+        try:
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    return
+                yield [ row[0:compiler.col_count] for row in rows ]
+        finally:
+            cursor.close()
+
+    def wrapper(result_type=MULTI, chunked_fetch=False):
+        if result_type != MULTI:
+            return execute_sql(result_type, chunked_fetch=chunked_fetch)
+        cursor = execute_sql(CURSOR, chunked_fetch=chunked_fetch)
+        return iter([]) if cursor is None else fetch_in_chunks(cursor)
+    return wrapper
+
+
+def concatenate_copies(spools, file, binary=False):
+    """Writes the COPY outputs in the spools, binary files, to file one after the other. Binary outputs keep only the
+    first one's header and the last one's trailer, so that the result is a single binary COPY output."""
+    decoder = codecs.getincrementaldecoder('utf-8')() if isinstance(file, io.TextIOBase) else None
+    for index, spool in enumerate(spools):
+        # SpooledTemporaryFile.seek() returns None before Python 3.7
+        spool.seek(0, io.SEEK_END)
+        end = spool.tell()
+        start = 0
+        if binary:
+            start = BINARY_COPY_HEADER_SIZE if index > 0 and end else 0
+            end -= BINARY_COPY_TRAILER_SIZE if index < len(spools) - 1 and end else 0
+        spool.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = spool.read(min(COPY_CHUNK_SIZE, remaining))
+            remaining -= len(chunk)
+            file.write(decoder.decode(chunk) if decoder else chunk)
+        spool.close()
+
+
+def copy_default(field, format, connection):
+    # A function returning the field's default as COPY input in the format spells it; callable defaults are called
+    # for every row. Binary input can only spell text fields and those in BINARY_COPY_STRUCTS.
+    def spelled():
+        value = field.get_db_prep_save(field.get_default(), connection)
+        if format == 'binary':
+            if value is None:
+                return BINARY_COPY_NULL
+            data = value.encode('utf-8') if collates(field) else \
+                struct.pack(BINARY_COPY_STRUCTS[field.get_internal_type()], value)
+            return struct.pack('>i', len(data)) + data
+        if value is None:
+            return '' if format == 'csv' else TEXT_COPY_NULL
+        value = str(value)
+        if format == 'text':
+            value = value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        return value
+    if field.has_default() and callable(field.default):
+        return spelled
+    value = spelled()
+    return lambda: value
+
+
+def copy_position(raw, format):
+    # The donor position in a row's discriminator field as it was in the input, or None if it's NULL or no integer
+    if format == 'binary':
+        if raw == BINARY_COPY_NULL or len(raw) - 4 not in (2, 4, 8):
+            return None
+        return int.from_bytes(raw[4:], 'big', signed=True)
+    try:
+        return int(raw)
+    except ValueError:
+        return None
+
+
+def binary_copy_rows(file):
+    # Each row of a binary COPY input, as a list of its fields, each as it was in the input: its length, then its data
+    header = read_exactly(file, BINARY_COPY_HEADER_SIZE)
+    if not header.startswith(BINARY_COPY_SIGNATURE):
+        raise ValueError("The input isn't in binary COPY format")
+    read_exactly(file, struct.unpack('>i', header[-4:])[0]) # header extension
+    while True:
+        count = struct.unpack('>h', read_exactly(file, 2))[0]
+        if count == -1:
+            return
+        row = []
+        for _ in range(count):
+            length = read_exactly(file, 4)
+            size = struct.unpack('>i', length)[0]
+            row.append(length + read_exactly(file, size) if size > 0 else length)
+        yield row
+
+
+def read_exactly(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError("The binary COPY input ends early")
+    return data
+
+
+def text_copy_rows(file):
+    # Values stay escaped, as COPY reads them back
+    for line in file:
+        line = line.rstrip('\n')
+        if line == TEXT_COPY_END:
+            return
+        yield line.split('\t')
+
+
+def copy_row_writer(spool, format):
+    # A function that writes a row, as split by binary_copy_rows(), csv.reader() or text_copy_rows(), to the spool
+    if format == 'csv':
+        return csv.writer(spool).writerow
+    if format == 'text':
+        return lambda row: spool.write('\t'.join(row) + '\n')
+    spool.write(BINARY_COPY_SIGNATURE + struct.pack('>ii', 0, 0))
+    return lambda row: spool.write(struct.pack('>h', len(row)) + b''.join(row))
+
+
+def estimated_rows(tables, using):
+    # The planner's estimate of each table's number of rows, by table name
+    if not tables:
+        return {}
+    with connections[using].cursor() as cursor:
+        cursor.execute(ESTIMATED_ROWS_SQL, [list(tables)])
+        return { table: rows or 0 for table, rows in cursor.fetchall() }
+
+
+def resolve_donors(rows, using, parallel=False):
+    """Sets donor_object on each of the view model instances in rows to the donor instance its row came from, or None
+    if that no longer exists, with one pk__in query per donor."""
+    by_position = {}
+    for row in rows:
+        split = row._combiner.split_id(row.pk)
+        setattr(row, DONOR_OBJECT, None)
+        if split is not None:
+            by_position.setdefault(split[0], []).append((row, split[1]))
+    if not by_position:
+        return
+    combiner = rows[0]._combiner
+    positions = sorted(by_position)
+
+    def fetch(position):
+        manager = combiner.donor_models[position]._default_manager.using(using)
+        return manager.in_bulk([ pk for _, pk in by_position[position] ])
+
+    found = parallel_map(fetch, positions, using) if parallel and len(positions) > 1 else map(fetch, positions)
+    for position, instances in zip(positions, found):
+        for row, pk in by_position[position]:
+            setattr(row, DONOR_OBJECT, instances.get(pk))
+
+
+def collates(field):
+    # Whether Postgres orders the field's values by a collation, rather than as Python compares them
+    return isinstance(field, (CharField, TextField))
+
+
+def combine_sums(partials):
+    values = [ value for value, in partials if value is not None ]
+    return sum(values) if values else None
+
+
+def combine_counts(partials):
+    return sum(value or 0 for value, in partials)
+
+
+def combine_mins(partials):
+    values = [ value for value, in partials if value is not None ]
+    return min(values) if values else None
+
+
+def combine_maxes(partials):
+    values = [ value for value, in partials if value is not None ]
+    return max(values) if values else None
+
+
+def combine_averages(partials):
+    total = combine_sums([ (value,) for value, _ in partials ])
+    count = combine_counts([ (count,) for _, count in partials ])
+    return float(total) / count if count else None
+
+
+# For each aggregate that can be split up by donor: the partial aggregates to compute for each donor, and the
+# function combining their values
+PARTIAL_AGGREGATES = {
+    Sum: ((Sum,), combine_sums),
+    Count: ((Count,), combine_counts),
+    Min: ((Min,), combine_mins),
+    Max: ((Max,), combine_maxes),
+    Avg: ((Sum, Count), combine_averages),
+}
+
+
+def encode_cursor(key, position, donor_pk):
+    data = json.dumps([key, position, donor_pk], cls=DjangoJSONEncoder)
+    return urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, field):
+    try:
+        key, position, donor_pk = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return field.to_python(key), int(position), donor_pk
+    except (TypeError, ValueError, ValidationError):
+        raise ValueError("Invalid keyset cursor: {!r}".format(cursor))
+
+
+class CombinedManager(Manager.from_queryset(CombinedQuerySet)):
+    def __init__(self, cache=None):
+        super(CombinedManager, self).__init__()
+        self.cache = cache # a combine.cache.ResultCache, or None not to cache results
+
+    def get_queryset(self):
+        queryset = super(CombinedManager, self).get_queryset()
+        queryset._view_cache = self.cache
+        return queryset
@@ -1,78 +1,509 @@
+from collections import namedtuple
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.utils import truncate_name
+from django.db.models.sql.query import Query
+
+# Name of the field/column that records which donor a row of a UNION ALL view came from. Its value is the donor's
+# position in Combiner.donors.
+DISCRIMINATOR = 'donor'
+# Name of the field/column that holds, next to DISCRIMINATOR, the row's primary key in its donor table. Together they
+# identify a row in a way that Postgres can push down to the donor's pk index, unlike the concatenated text id.
+DONOR_PK = 'donor_pk'
+GENERATED_COLUMNS = (DISCRIMINATOR, DONOR_PK)
+
 #SQL writing
 INDENT2 = "  "
 INDENT7 = "       "
 X_AS_Y = "{x} AS {y}"
+NULL = "NULL"
+MAX_NAME_LENGTH = 63 # Postgres' NAMEDATALEN - 1
 
 DROP_VIEW = """
-DROP VIEW IF EXISTS {db_view}"""
+DROP VIEW IF EXISTS {db_view};"""
+
+DROP_MATERIALIZED_VIEW = """
+DROP MATERIALIZED VIEW IF EXISTS {db_view};"""
 
 CREATE_VIEW = """
 CREATE OR REPLACE VIEW {db_view} AS
-{selection}"""
+{selection};"""
+
+CREATE_MATERIALIZED_VIEW = """
+CREATE MATERIALIZED VIEW {db_view} AS
+{selection};"""
+
+CREATE_INDEX = """
+CREATE {unique}INDEX {index_name} ON {db_view} ({columns});"""
+
+REFRESH_MATERIALIZED_VIEW = """
+REFRESH MATERIALIZED VIEW {concurrently}{db_view}"""
+
+# Materialized views remember when they were last refreshed in their comment
+REFRESH_COMMENT_PREFIX = "dj-combine refreshed at "
+
+REFRESH_COMMENT = """
+COMMENT ON MATERIALIZED VIEW {db_view} IS '""" + REFRESH_COMMENT_PREFIX + "{refreshed_at}'"
+
+LAST_REFRESH_SQL = "SELECT obj_description(to_regclass(%s), 'pg_class')"
+
+# The planner's row estimate for each of the tables, from the last VACUUM or ANALYZE; -1 or 0 if there never was one
+ESTIMATED_ROWS_SQL = """
+SELECT tables.name, greatest(pg_class.reltuples, 0)::bigint
+       FROM unnest(%s::text[]) AS tables(name)
+       LEFT JOIN pg_class ON pg_class.oid = to_regclass(tables.name)"""
+
+CREATE_TABLE = """
+CREATE TABLE {db_view} AS
+{selection}
+WITH NO DATA;
+ALTER TABLE {db_view} ADD CONSTRAINT {pkey} PRIMARY KEY ({id});"""
+
+# Rows the sync triggers already wrote are as new as the selection's, or newer
+FILL_TABLE = """
+INSERT INTO {db_view}
+{selection}
+ON CONFLICT ({id}) DO NOTHING;"""
+
+DROP_TABLE = """
+DROP TABLE IF EXISTS {db_view};"""
+
+# Keeps an incremental combined table in step with one donor table
+CREATE_SYNC_TRIGGER = """
+CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'TRUNCATE' THEN
+    DELETE FROM {db_view} WHERE left({id}, {prefix_length}) = '{model_table}.';
+    RETURN NULL;
+  END IF;
+  IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.{model_pk} IS DISTINCT FROM NEW.{model_pk}) THEN
+    DELETE FROM {db_view} WHERE {id} = concat('{model_table}.', OLD.{model_pk}::text);
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO {db_view} ({columns})
+    VALUES ({values})
+    ON CONFLICT ({id}) DO UPDATE SET {assignments};
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER {function} AFTER INSERT OR UPDATE OR DELETE ON {model_table}
+  FOR EACH ROW EXECUTE PROCEDURE {function}();
+CREATE TRIGGER {function}_truncate AFTER TRUNCATE ON {model_table}
+  FOR EACH STATEMENT EXECUTE PROCEDURE {function}();"""
+
+# Dropping the function takes its triggers with it
+DROP_SYNC_TRIGGER = """
+DROP FUNCTION IF EXISTS {function}() CASCADE;"""
+
+# A new definition is built under a swap name, then renamed into place once the old one is dropped
+SWAP_SUFFIX = '_swap'
+
+RENAME = """
+ALTER {kind} {old_name} RENAME TO {new_name};"""
+
+SHOW_LOCK_TIMEOUT_SQL = "SELECT current_setting('lock_timeout')"
+# Lasts until the end of the transaction, or of the savepoint if it is rolled back
+SET_LOCK_TIMEOUT_SQL = "SELECT set_config('lock_timeout', %s, true)"
+
+COPY_TO_STDOUT = "COPY ({query}) TO STDOUT WITH (FORMAT {format}{header})"
+
+COPY_FROM_STDIN = "COPY {db_table} ({columns}) FROM STDIN WITH (FORMAT {format}{not_null})"
+
+UNION = "UNION"
+UNION_ALL = "UNION ALL"
 
-SELECTION_WITH_UNION =\
-INDENT2 + "SELECT {id_construction}{fields_and_renames}" +\
-INDENT2 + INDENT7 + "FROM {db_table}\n" + \
-INDENT2 + "UNION\n" +\
-"{next_selection}"
+SELECTION =\
+INDENT2 + "SELECT {columns}" +\
+INDENT2 + INDENT7 + "FROM {db_table}{joins}{where}"
 
-SELECTION_FINAL =\
-INDENT2 + "SELECT {id_construction}{fields_and_renames}" +\
-INDENT2 + INDENT7 + "FROM {db_table}"
+# A branch of a selection built at query time, which may filter, order and limit its own rows
+SELECTION_BRANCH =\
+INDENT2 + "(SELECT {columns}" +\
+INDENT2 + INDENT7 + "FROM {db_table}{joins}{where}{order_by}{limit})"
+
+# A LEFT JOIN on a unique key that nothing reads from is left out by Postgres, so queries that read none of a
+# parent's columns from a view don't pay for its join
+BRANCH_JOIN = "\n" + INDENT2 + INDENT7 + "LEFT JOIN {db_table} ON {db_table}.{pk_column} = {child_table}.{link_column}"
+BRANCH_WHERE = "\n" + INDENT2 + INDENT7 + "WHERE {conditions}"
+BRANCH_ORDER_BY = "\n" + INDENT2 + INDENT7 + "ORDER BY {ordering}"
+BRANCH_LIMIT = "\n" + INDENT2 + INDENT7 + "LIMIT {limit}"
 
 ID_CONSTRUCTION = X_AS_Y.format(x="concat('{model_table}.', {model_pk}::text)", y="{id}")
 
-FIELDS_AND_RENAMES =",\n" +\
-INDENT2 + INDENT7 + "{field_and_rename}{fields_and_renames}"
+DISCRIMINATOR_CONSTRUCTION = ",\n" +\
+INDENT2 + INDENT7 + X_AS_Y.format(x="{discriminator}::smallint", y=DISCRIMINATOR)
+
+DONOR_PK_CONSTRUCTION = ",\n" +\
+INDENT2 + INDENT7 + X_AS_Y.format(x="{model_pk}", y=DONOR_PK)
+
+FIELD_AND_RENAME = ",\n" +\
+INDENT2 + INDENT7 + "{field_and_rename}"
+
+# How many generated selections are remembered, by the plan they were generated from
+SQL_CACHE_SIZE = 256
+
+def construction_sql(view_model, donors, renames, union_all=False, materialized=False, indexes=(), incremental=False,
+                     connection=None, db_view=None, filters=None):
+    # db_view optionally builds the view under another name than its model's table
+    db_view = db_view or view_model._meta.db_table
+    plan = selection_plan(view_model, donors, renames, union_all=union_all, connection=connection, filters=filters)
+    selection = render_selection(plan)
+    all_indexes = ''.join(index_sql(db_view, columns, unique=unique)
+                          for columns, unique in view_indexes(view_model, union_all, materialized, indexes,
+                                                              incremental))
+    if incremental:
+        # The triggers come before the rows, so no donor change committed in between is lost; creating them also
+        # locks out writes to the donors until the transaction ends
+        id_column = view_model._meta.pk.column
+        return CREATE_TABLE.format(db_view=db_view, selection=selection, id=id_column, pkey=pkey_name(db_view)) + \
+               ''.join(sync_trigger_sql(view_model, branch, db_view=db_view) for branch in plan.branches) + \
+               FILL_TABLE.format(db_view=db_view, selection=selection, id=id_column) + \
+               all_indexes
+    if not materialized:
+        return CREATE_VIEW.format(db_view=db_view, selection=selection)
+    return CREATE_MATERIALIZED_VIEW.format(db_view=db_view, selection=selection) + all_indexes
 
-def construction_sql(view_model, donors, renames):
-    db_view = view_model._meta.db_table
-    selection = selection_sql(view_model, donors, renames)
-    return CREATE_VIEW.format(db_view=db_view, selection=selection)
 
+def view_indexes(view_model, union_all=False, materialized=False, indexes=(), incremental=False):
+    # (columns, unique) of each index construction_sql builds, in order
+    if not (materialized or incremental):
+        return []
+    built = [ ([view_model._meta.get_field(name).column for name in index], False) for index in indexes ]
+    if union_all and has_donor_pk(view_model):
+        built.insert(0, (list(GENERATED_COLUMNS), True))
+    if not incremental:
+        # REFRESH ... CONCURRENTLY needs a unique index, and the id is unique by construction
+        built.insert(0, ([view_model._meta.pk.column], True))
+    return built
 
-def destruction_sql(view_model):
+
+def swap_name(db_view):
+    return truncate_name(db_view + SWAP_SUFFIX, MAX_NAME_LENGTH)
+
+
+def swap_sql(view_model, donors, renames, union_all=False, materialized=False, indexes=(), incremental=False):
+    """Moves the definition construction_sql built under swap_name() into the view's place, indexes and all. The
+    view's old definition must be dropped first."""
     db_view = view_model._meta.db_table
+    db_swap = swap_name(db_view)
+    kind = 'TABLE' if incremental else 'MATERIALIZED VIEW' if materialized else 'VIEW'
+    renamed = [ (index_name(db_swap, columns, unique), index_name(db_view, columns, unique))
+                for columns, unique in view_indexes(view_model, union_all, materialized, indexes, incremental) ]
+    if incremental:
+        renamed.insert(0, (pkey_name(db_swap), pkey_name(db_view)))
+    sql = RENAME.format(kind=kind, old_name=db_swap, new_name=db_view) + \
+          ''.join(RENAME.format(kind='INDEX', old_name=old_name, new_name=new_name) for old_name, new_name in renamed)
+    if incremental:
+        # The swap table's triggers write to it by name, so they are replaced by triggers writing to the view's
+        plan = selection_plan(view_model, donors, renames, union_all=union_all)
+        sql += ''.join(sync_trigger_sql(view_model, branch) for branch in plan.branches) + \
+               ''.join(DROP_SYNC_TRIGGER.format(function=sync_function_name(db_swap, branch.db_table))
+                       for branch in plan.branches)
+    return sql
+
+
+def destruction_sql(view_model, materialized=False, incremental=False, donors=(), db_view=None):
+    db_view = db_view or view_model._meta.db_table
+    if incremental:
+        return ''.join(DROP_SYNC_TRIGGER.format(function=sync_function_name(db_view, donor._meta.db_table))
+                       for donor in donors) + \
+               DROP_TABLE.format(db_view=db_view)
+    if materialized:
+        return DROP_MATERIALIZED_VIEW.format(db_view=db_view)
     return DROP_VIEW.format(db_view=db_view)
 
 
-def id_construction(view_model, contributor_model):
-    return ID_CONSTRUCTION.format(model_table=contributor_model._meta.db_table,
-                                  model_pk=contributor_model._meta.pk.name,
-                                  id=view_model._meta.pk.name)
+def copy_sql(query, format='csv', header=False):
+    # query is a complete SELECT, since COPY takes no parameters
+    return COPY_TO_STDOUT.format(query=query, format=format, header=', HEADER' if header else '')
+
+
+def copy_from_sql(db_table, columns, format='csv', not_null=()):
+    # not_null are csv columns whose empty values load as empty strings rather than NULL
+    not_null = ', FORCE_NOT_NULL ({})'.format(', '.join(not_null)) if format == 'csv' and not_null else ''
+    return COPY_FROM_STDIN.format(db_table=db_table, columns=', '.join(columns), format=format, not_null=not_null)
+
+
+def sync_function_name(db_view, model_table):
+    return truncate_name('{}_{}_sync'.format(db_view, model_table), MAX_NAME_LENGTH)
+
+
+def sync_trigger_sql(view_model, branch, db_view=None):
+    # branch is the donor's Branch of the view's selection plan
+    if branch.joins:
+        # the trigger only sees the donor's own row, and no changes to its parents' rows
+        raise ValueError("An incremental view can't read columns that {} inherits from its parents"
+                         .format(branch.db_table))
+    db_view = db_view or view_model._meta.db_table
+    model_table = branch.db_table
+    model_pk = branch.pk_column
+    id_column = view_model._meta.pk.column
+    columns_and_values = [ (id_column, "concat('{}.', NEW.{}::text)".format(model_table, model_pk)) ]
+    if branch.discriminator is not None:
+        columns_and_values.append((DISCRIMINATOR, "{}::smallint".format(branch.discriminator)))
+        if branch.with_donor_pk:
+            columns_and_values.append((DONOR_PK, "NEW.{}".format(model_pk)))
+    for column in branch.columns:
+        columns_and_values.append((column.target, NULL if column.source is None else 'NEW.' + column.source))
+    function = sync_function_name(db_view, model_table)
+    return CREATE_SYNC_TRIGGER.format(function=function,
+                                      db_view=db_view,
+                                      id=id_column,
+                                      model_table=model_table,
+                                      model_pk=model_pk,
+                                      prefix_length=len(model_table) + 1,
+                                      columns=', '.join(column for column, _ in columns_and_values),
+                                      values=', '.join(value for _, value in columns_and_values),
+                                      assignments=', '.join('{0} = EXCLUDED.{0}'.format(column)
+                                                            for column, _ in columns_and_values[1:]))
+
+
+def index_name(db_view, columns, unique=False):
+    return truncate_name('_'.join([db_view] + list(columns) + ['uniq' if unique else 'idx']), MAX_NAME_LENGTH)
+
+
+def pkey_name(db_view):
+    # Postgres' own name for the constraint, for names short enough not to be truncated
+    return truncate_name(db_view + '_pkey', MAX_NAME_LENGTH)
+
 
+def index_sql(db_view, columns, unique=False):
+    return CREATE_INDEX.format(unique='UNIQUE ' if unique else '',
+                               index_name=index_name(db_view, columns, unique),
+                               db_view=db_view,
+                               columns=', '.join(columns))
 
-def selection_sql(view_model, donors, renames):
-    reverse_donors = list(reversed(donors))
-    final_contributor = reverse_donors.pop(0)
-    selection = SELECTION_FINAL.format(id_construction=id_construction(view_model, final_contributor),
-                                       fields_and_renames=fields_and_renames(view_model, final_contributor, renames),
-                                       db_table=final_contributor._meta.db_table)
-    for contributor_model in reverse_donors:
-        selection = SELECTION_WITH_UNION.format(id_construction=id_construction(view_model, contributor_model),
-                                                fields_and_renames=fields_and_renames(view_model, contributor_model, renames),
-                                                db_table=contributor_model._meta.db_table,
-                                                next_selection=selection)
-    return selection + '\n'
 
+def refresh_sql(view_model, concurrently=True):
+    return REFRESH_MATERIALIZED_VIEW.format(concurrently='CONCURRENTLY ' if concurrently else '',
+                                            db_view=view_model._meta.db_table)
 
-def fields_and_renames(view_model, donor_model, renames):
-    fields = [ field for field in list(reversed(view_model._meta.fields)) if field is not view_model._meta.pk ]
-    fields_and_renames = ""
+
+def refresh_comment_sql(view_model, refreshed_at):
+    return REFRESH_COMMENT.format(db_view=view_model._meta.db_table, refreshed_at=refreshed_at.isoformat())
+
+
+def has_donor_pk(view_model):
+    return any(field.column == DONOR_PK for field in view_model._meta.fields)
+
+
+class Plan(namedtuple('Plan', 'id_column union_all branches')):
+    """Everything a selection over a view's donors is generated from, worked out once: the view's id column, whether
+    to UNION ALL, and a Branch per donor. Being made of tuples, it is immutable, hashable, and fingerprints the
+    combiner definition."""
+    __slots__ = ()
+
+
+class Branch(namedtuple('Branch', 'db_table pk_column discriminator with_donor_pk columns where joins')):
+    """A donor's part of a Plan: its table and pk column, its discriminator (None without UNION ALL), whether it
+    fills in donor_pk, a Column for each of the other view fields, in order, the condition its rows must meet,
+    if the Combiner filters the donor (see filter_sql()), and a Join for each multi-table inheritance parent it reads
+    from."""
+    __slots__ = ()
+
+
+class Join(namedtuple('Join', 'db_table pk_column child_table link_column')):
+    """A multi-table inheritance parent's table, joined on its pk to the link column of a child: the donor itself, or
+    another parent in between."""
+    __slots__ = ()
+
+
+class Column(namedtuple('Column', 'source target cast')):
+    """A view column and the donor column that feeds it, or None if the donor contributes NULL. A NULL is cast to the
+    view column's type, if known, so that it can't throw off the type of the union's column."""
+    __slots__ = ()
+
+
+def selection_plan(view_model, donors, renames, union_all=False, connection=None, filters=None):
+    # connection is only needed to know the types to cast NULLs to; filters is a {donor model: Q object} dict
+    with_donor_pk = union_all and has_donor_pk(view_model)
+    fields = view_fields(view_model, skip_generated=union_all)
+    filters = filters or {}
+    branches = []
+    for position, donor in enumerate(donors):
+        columns = column_plan(fields, donor, renames, connection)
+        where, tables = filter_sql(donor, filters[donor], connection) if donor in filters else (None, set())
+        tables |= { column.source.partition('.')[0] for column in columns if column.source and '.' in column.source }
+        branches.append(Branch(donor._meta.db_table, donor._meta.pk.column, position if union_all else None,
+                               with_donor_pk, columns, where, parent_joins(donor, tables) if tables else ()))
+    return Plan(view_model._meta.pk.column, union_all, tuple(branches))
+
+
+def filter_sql(donor_model, q_object, connection=None):
+    """Renders a Q object on the donor's own fields, or those it inherits, as a condition for its branch of a view
+    definition, with its values inlined. Returns the condition and the tables of the parents it reads from."""
+    connection = connection or connections[DEFAULT_DB_ALIAS]
+    query = Query(donor_model)
+    query.add_q(q_object)
+    parent_tables = { parent._meta.db_table for parent in donor_model._meta.get_parent_list() }
+    # joins that lookups on foreign key columns trimmed are left in the alias map unreferenced
+    tables = { join.table_name for alias, join in query.alias_map.items()
+               if query.alias_refcount[alias] } - {donor_model._meta.db_table}
+    if not tables <= parent_tables:
+        raise ValueError("Combiner filters can only use the donor's own fields, not those of {}'s relations"
+                         .format(donor_model.__name__))
+    sql, params = query.where.as_sql(query.get_compiler(connection=connection), connection)
+    return inline_params(sql, params, connection), tables
+
+
+def inline_params(sql, params, connection):
+    # psycopg2 quotes the values itself, in the connection's encoding, which Django forces to UTF8; the schema
+    # editor's quote_value() quotes them with no connection, in latin-1
+    with connection.cursor() as cursor:
+        if hasattr(cursor, 'mogrify'):
+            return cursor.mogrify(sql, params).decode('utf-8')
+    quote_value = connection.schema_editor().quote_value
+    return sql % tuple(quote_value(param) for param in params)
+
+
+def parent_joins(donor_model, tables):
+    """The Joins a donor's branch needs to read from the multi-table inheritance parents with the given tables, and
+    no others. Parent links are usually the child's pk, so every parent's pk equals the donor's, and each parent is
+    joined on the donor's pk directly, skipping the parents in between. Otherwise the chain of links is followed."""
+    joins = []
+    joined = {donor_model._meta.db_table}
+    for parent in donor_model._meta.get_parent_list():
+        if parent._meta.db_table not in tables or parent._meta.db_table in joined:
+            continue
+        links = []
+        child = donor_model
+        for ancestor in donor_model._meta.get_base_chain(parent):
+            links.append((child, child._meta.parents[ancestor], ancestor))
+            child = ancestor
+        if all(link.primary_key for _, link, _ in links):
+            links = [(donor_model, donor_model._meta.pk, parent)]
+        for child, link, ancestor in links:
+            if ancestor._meta.db_table not in joined:
+                joins.append(Join(ancestor._meta.db_table, ancestor._meta.pk.column, child._meta.db_table,
+                                  link.column))
+                joined.add(ancestor._meta.db_table)
+    return tuple(joins)
+
+
+def joins_sql(branch):
+    return ''.join(BRANCH_JOIN.format(**join._asdict()) for join in branch.joins)
+
+
+def column_plan(fields, donor_model, renames, connection=None):
+    columns = []
     for field in fields:
-        fields_and_renames = FIELDS_AND_RENAMES.format(field_and_rename=field_and_rename(field, donor_model, renames),
-                                                       fields_and_renames=fields_and_renames)
-    return fields_and_renames + '\n'
+        source = field_source(field, donor_model, renames)
+        cast = field.db_type(connection) if source is None and connection is not None else None
+        columns.append(Column(source, field.column, cast))
+    return tuple(columns)
 
 
-def field_and_rename(field, donor_model, renames):
-    new_column = field.column
+@lru_cache(maxsize=SQL_CACHE_SIZE)
+def branch_columns_sql(id_column, branch, projection=None):
+    # projection optionally leaves out the view columns not in it; the id is always kept, as UNION deduplicates by it
+    def projected(column):
+        return projection is None or column in projection
+    # a parent could have a column of the same name as the donor's pk
+    model_pk = '{}.{}'.format(branch.db_table, branch.pk_column) if branch.joins else branch.pk_column
+    parts = [ ID_CONSTRUCTION.format(model_table=branch.db_table, model_pk=model_pk, id=id_column) ]
+    if branch.discriminator is not None:
+        if projected(DISCRIMINATOR):
+            parts.append(DISCRIMINATOR_CONSTRUCTION.format(discriminator=branch.discriminator))
+        if branch.with_donor_pk and projected(DONOR_PK):
+            parts.append(DONOR_PK_CONSTRUCTION.format(model_pk=model_pk))
+    parts.append(columns_sql([ column for column in branch.columns if projected(column.target) ]))
+    return ''.join(parts)
+
+
+@lru_cache(maxsize=SQL_CACHE_SIZE)
+def render_selection(plan, only=None):
+    union = UNION_ALL if plan.union_all else UNION
+    selections = [ SELECTION.format(columns=branch_columns_sql(plan.id_column, branch), db_table=branch.db_table,
+                                    joins=joins_sql(branch),
+                                    where=BRANCH_WHERE.format(conditions=branch.where) if branch.where else "")
+                   for position, branch in enumerate(plan.branches) if only is None or position in only ]
+    return ('\n' + INDENT2 + union + '\n').join(selections) + '\n'
+
+
+def selection_sql(view_model, donors, renames, union_all=False, only=None):
+    # With UNION ALL, every branch is tagged with its donor's position in donors, so rows need no deduplication
+    # 'only' optionally restricts the selection to the donors at those positions
+    plan = selection_plan(view_model, donors, renames, union_all=union_all)
+    return render_selection(plan, None if only is None else frozenset(only))
+
+
+def query_selection_sql(plan, only=None, branch_where=None, order_by=(), limit=None, projection=None):
+    """Builds a selection like render_selection's at query time, with optional WHERE, ORDER BY and LIMIT clauses
+    inside every branch. branch_where(position) returns a (sql, params) condition on the donor's own columns, or None.
+    order_by is a sequence of (view column, descending) pairs. projection, a frozenset of view columns, optionally
+    leaves out the others. Returns the SQL and its params."""
+    union = UNION_ALL if plan.union_all else UNION
+    ordering = ', '.join(column + (' DESC' if descending else '') for column, descending in order_by)
+    selections = []
+    params = []
+    for position, branch in enumerate(plan.branches):
+        if only is not None and position not in only:
+            continue
+        where = branch_where(position) if branch_where else None
+        if where is not None:
+            params.extend(where[1])
+        if branch.where:
+            # the filter's values are inlined, so any % in it must survive the query's own params
+            filtered = '({})'.format(branch.where.replace('%', '%%'))
+            where = (filtered + ' AND ({})'.format(where[0]) if where is not None else filtered, ())
+        selections.append(SELECTION_BRANCH.format(
+            columns=branch_columns_sql(plan.id_column, branch, projection),
+            db_table=branch.db_table,
+            joins=joins_sql(branch),
+            where=BRANCH_WHERE.format(conditions=where[0]) if where is not None else "",
+            # output column names can be used in a branch's ORDER BY, so ordering needs no renaming
+            order_by=BRANCH_ORDER_BY.format(ordering=ordering) if ordering else "",
+            limit=BRANCH_LIMIT.format(limit=int(limit)) if limit is not None else ""))
+    return ('\n' + INDENT2 + union + '\n').join(selections) + '\n', params
+
+
+def view_fields(view_model, skip_generated=False):
+    fields = [ field for field in view_model._meta.fields if field is not view_model._meta.pk ]
+    if skip_generated:
+        fields = [ field for field in fields if field.column not in GENERATED_COLUMNS ]
+    return fields
+
+
+def fields_and_renames(view_model, donor_model, renames, skip_generated=False):
+    fields = view_fields(view_model, skip_generated=skip_generated)
+    return columns_sql(column_plan(fields, donor_model, renames))
+
+
+def columns_sql(columns):
+    return ''.join([ FIELD_AND_RENAME.format(field_and_rename=source_as_column(*column)) for column in columns ]) + '\n'
+
+
+def field_source(field, donor_model, renames):
+    # The donor column that feeds a view field: its rename if it has one, else the column of the same name. None if the
+    # donor has no such field, in which case its rows get NULL in that column. The column of a field the donor inherits
+    # through multi-table inheritance is qualified with its parent's table.
     old_column = None
     try:
-        old_column = renames[new_column][donor_model]
+        old_column = renames[field.column][donor_model]
     except KeyError:
         pass
+    try:
+        donor_field = donor_model._meta.get_field(old_column or field.name)
+    except FieldDoesNotExist:
+        return old_column
+    parent = getattr(donor_field, 'model', None)
+    if isinstance(parent, type) and parent._meta.db_table != donor_model._meta.db_table and \
+            issubclass(donor_model, parent):
+        return '{}.{}'.format(parent._meta.db_table, donor_field.column)
+    return old_column or field.column
+
+
+def field_and_rename(field, donor_model, renames):
+    return source_as_column(field_source(field, donor_model, renames), field.column)
+
+
+def source_as_column(old_column, new_column, cast=None):
     if old_column is None:
+        return X_AS_Y.format(x=NULL + ('::' + cast if cast else ''), y=new_column)
+    if old_column == new_column:
         return new_column
     return X_AS_Y.format(x=old_column,
-                         y=new_column)
\ No newline at end of file
+                         y=new_column)
@@ -1,12 +1,23 @@
-import re, six
-from unittest import TestCase
+import io, re, six, struct
+from tempfile import SpooledTemporaryFile
+from unittest import TestCase, skipUnless
 from unittest.mock import Mock, MagicMock, patch
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.apps import apps
+from django.db import connection, transaction
 from django.db.models.base import ModelBase, Model
+from django.db.models import Avg, Count, F, Max, Min, Q, Sum
+from django.db.models.query import ValuesIterable
 from django.db.models.fields import TextField
-from django.test import TestCase as DjTestCase
+from django.test import TestCase as DjTestCase, TransactionTestCase
 from example_models import models
-from . import sqlfuncs
-from .base import Rename, CombinedModelView, CombinedModelViewBase
+from django.db.migrations import Migration
+from django.db.migrations.graph import MigrationGraph
+from django.db.migrations.operations import AddField, AlterField, RemoveField
+from django.db.migrations.state import ProjectState
+from . import cache, operations, parallel, query, sqlfuncs
+from .management.commands import makecombinedviews
+from .base import DISCRIMINATOR, Rename, CombineOptions, CombinedModelView, CombinedModelViewBase
 
 INDENT_TWICE = sqlfuncs.INDENT2 + sqlfuncs.INDENT7
 
@@ -36,6 +47,7 @@ def mock_model(tblname, fieldname_list, app_label=None):
     donor._meta.db_table = tblname
     donor._meta.pk = Mock()
     donor._meta.pk.name = 'id'
+    donor._meta.pk.column = 'id'
     donor._meta.fields = field_mocks(fieldname_list)
     donor._meta.app_label = app_label or MOCK_APP_LABEL
     donor._meta.model_name = tblname
@@ -67,6 +79,16 @@ class TestSqlFuncs(TestCase):
                           sqlfuncs.X_AS_Y.format(x=str(full_renames[column][donor_model]), y=column))
         pass
 
+    def test_field_and_rename_missing_from_donor(self):
+        field = FieldMock(name='column')
+        donor_model = mock_model('donor', [])
+        donor_model._meta.get_field = Mock(side_effect=FieldDoesNotExist)
+        self.assertEqual(sqlfuncs.field_and_rename(field, donor_model, {}),
+                         sqlfuncs.X_AS_Y.format(x='NULL', y='column'))
+        field.db_type = Mock(return_value='integer')
+        columns = sqlfuncs.column_plan([field], donor_model, {}, connection=Mock())
+        self.assertEqual(sqlfuncs.columns_sql(columns).strip(', \n'), 'NULL::integer AS column')
+
     def test_fields_and_renames(self):
         view_model = Mock(name='view_model')
         view_model._meta = Mock(name='view_model_meta')
@@ -112,14 +134,127 @@ class TestSqlFuncs(TestCase):
                b,
                c
                FROM donor3
+        ;
         """
         gen_sql = sqlfuncs.construction_sql(view_model, [donor1, donor2, donor3], {})
         self.assertEqual(test_sql.split(), gen_sql.split())
 
+    def test_construction_sql_union_all(self):
+        view_model = mock_model('view', ['a', 'donor'])
+        donor1 = mock_model('donor1', ['a'])
+        donor2 = mock_model('donor2', ['a'])
+        test_sql = """
+        CREATE OR REPLACE VIEW view AS
+        SELECT concat('donor1.', id::text) AS id,
+               0::smallint AS donor,
+               a
+               FROM donor1
+        UNION ALL
+        SELECT concat('donor2.', id::text) AS id,
+               1::smallint AS donor,
+               a
+               FROM donor2
+        ;
+        """
+        gen_sql = sqlfuncs.construction_sql(view_model, [donor1, donor2], {}, union_all=True)
+        self.assertEqual(test_sql.split(), gen_sql.split())
+
+    def test_selection_sql_memoized(self):
+        view_model = mock_model('view', ['a', 'donor'])
+        donors = [ mock_model('donor{}'.format(i), ['a']) for i in range(2) ]
+        plan = sqlfuncs.selection_plan(view_model, donors, {}, union_all=True)
+        self.assertEqual(plan.branches[1],
+                         sqlfuncs.Branch('donor1', 'id', 1, False, (sqlfuncs.Column('a', 'a', None),), None, ()))
+        sql = sqlfuncs.selection_sql(view_model, donors, {}, union_all=True)
+        hits = sqlfuncs.render_selection.cache_info().hits
+        # models rebuilt from the same definition, as in each migration state, share the generated SQL
+        donors = [ mock_model('donor{}'.format(i), ['a']) for i in range(2) ]
+        self.assertEqual(sqlfuncs.selection_sql(view_model, donors, {}, union_all=True), sql)
+        self.assertEqual(sqlfuncs.render_selection.cache_info().hits, hits + 1)
+
+    def test_construction_sql_materialized(self):
+        view_model = mock_model('view', ['a', 'b'])
+        view_model._meta.get_field = lambda name: FieldMock(name=name)
+        donor1 = mock_model('donor1', ['a', 'b'])
+        test_sql = """
+        CREATE MATERIALIZED VIEW view AS
+        SELECT concat('donor1.', id::text) AS id,
+               a,
+               b
+               FROM donor1
+        ;
+        CREATE UNIQUE INDEX view_id_uniq ON view (id);
+        CREATE INDEX view_a_b_idx ON view (a, b);
+        """
+        gen_sql = sqlfuncs.construction_sql(view_model, [donor1], {}, materialized=True, indexes=[('a', 'b')])
+        self.assertEqual(test_sql.split(), gen_sql.split())
+        self.assertEqual(sqlfuncs.destruction_sql(view_model, materialized=True).split(),
+                         "DROP MATERIALIZED VIEW IF EXISTS view;".split())
+        self.assertEqual(sqlfuncs.refresh_sql(view_model).split(),
+                         "REFRESH MATERIALIZED VIEW CONCURRENTLY view".split())
+
+    def test_sync_trigger_sql(self):
+        view_model = mock_model('view', ['a', 'donor'])
+        donor1 = mock_model('donor1', ['b'])
+        test_sql = """
+        CREATE OR REPLACE FUNCTION view_donor1_sync() RETURNS trigger AS $$
+        BEGIN
+          IF TG_OP = 'TRUNCATE' THEN
+            DELETE FROM view WHERE left(id, 7) = 'donor1.';
+            RETURN NULL;
+          END IF;
+          IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.id IS DISTINCT FROM NEW.id) THEN
+            DELETE FROM view WHERE id = concat('donor1.', OLD.id::text);
+          END IF;
+          IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO view (id, donor, a)
+            VALUES (concat('donor1.', NEW.id::text), 3::smallint, NEW.b)
+            ON CONFLICT (id) DO UPDATE SET donor = EXCLUDED.donor, a = EXCLUDED.a;
+          END IF;
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        CREATE TRIGGER view_donor1_sync AFTER INSERT OR UPDATE OR DELETE ON donor1
+          FOR EACH ROW EXECUTE PROCEDURE view_donor1_sync();
+        CREATE TRIGGER view_donor1_sync_truncate AFTER TRUNCATE ON donor1
+          FOR EACH STATEMENT EXECUTE PROCEDURE view_donor1_sync();
+        """
+        donors = [ mock_model('donor{}'.format(i), ['a']) for i in (4, 5, 6) ] + [donor1]
+        plan = sqlfuncs.selection_plan(view_model, donors, {'a': {donor1: 'b'}}, union_all=True)
+        gen_sql = sqlfuncs.sync_trigger_sql(view_model, plan.branches[3])
+        self.assertEqual(test_sql.split(), gen_sql.split())
+        gen_sql = sqlfuncs.construction_sql(view_model, donors, {'a': {donor1: 'b'}}, union_all=True, incremental=True)
+        # the triggers are in place before the table is filled
+        self.assertLess(gen_sql.index('WITH NO DATA;'), gen_sql.index('CREATE TRIGGER view_donor1_sync AFTER'))
+        self.assertLess(gen_sql.index('CREATE TRIGGER view_donor1_sync AFTER'), gen_sql.index('INSERT INTO view\n'))
+        self.assertIn('ON CONFLICT (id) DO NOTHING;', gen_sql)
+        self.assertEqual(sqlfuncs.destruction_sql(view_model, incremental=True, donors=[donor1]).split(),
+                         "DROP FUNCTION IF EXISTS view_donor1_sync() CASCADE; DROP TABLE IF EXISTS view;".split())
+
+    def test_swap_sql(self):
+        view_model = mock_model('view', ['a', 'b'])
+        view_model._meta.get_field = lambda name: FieldMock(name=name)
+        donor1 = mock_model('donor1', ['a', 'b'])
+        gen_sql = sqlfuncs.construction_sql(view_model, [donor1], {}, materialized=True, indexes=[('a',)],
+                                            db_view=sqlfuncs.swap_name('view'))
+        self.assertIn("CREATE INDEX view_swap_a_idx ON view_swap (a);", gen_sql)
+        test_sql = """
+        ALTER MATERIALIZED VIEW view_swap RENAME TO view;
+        ALTER INDEX view_swap_id_uniq RENAME TO view_id_uniq;
+        ALTER INDEX view_swap_a_idx RENAME TO view_a_idx;
+        """
+        gen_sql = sqlfuncs.swap_sql(view_model, [donor1], {}, materialized=True, indexes=[('a',)])
+        self.assertEqual(test_sql.split(), gen_sql.split())
+        gen_sql = sqlfuncs.swap_sql(view_model, [donor1], {}, incremental=True)
+        self.assertTrue(gen_sql.startswith("\nALTER TABLE view_swap RENAME TO view;"
+                                           "\nALTER INDEX view_swap_pkey RENAME TO view_pkey;"))
+        self.assertIn("CREATE TRIGGER view_donor1_sync AFTER", gen_sql)
+        self.assertTrue(gen_sql.endswith("DROP FUNCTION IF EXISTS view_swap_donor1_sync() CASCADE;"))
+
     def test_destruction_sql(self):
         view_model = mock_model('view', ['a', 'b', 'c'])
         test_sql = """
-        DROP VIEW IF EXISTS view
+        DROP VIEW IF EXISTS view;
         """
         gen_sql = sqlfuncs.destruction_sql(view_model)
         self.assertEqual(test_sql.split(), gen_sql.split())
@@ -137,19 +272,220 @@ class TestCombinedViewOperationPrivateMethods(TestCase):
         pass
 
 
+class TestAlterCombinedView(DjTestCase):
+
+    def definition(self, **options):
+        return dict(makecombinedviews.view_definition(models.Pet), fingerprint=None, **options)
+
+    def alter(self, previous, **options):
+        return operations.AlterCombinedView('Pet', previous=previous, **self.definition(**options))
+
+    def swap_statements(self, operation):
+        state = ProjectState.from_apps(apps)
+        with connection.schema_editor(collect_sql=True) as schema_editor:
+            operation.database_forwards('example_models', schema_editor, state, state)
+        return [ statement.strip().split('\n')[0] for statement in schema_editor.collected_sql ]
+
+    def test_swap_statements(self):
+        # every fragment of the swap is a statement of its own, whatever the old and new definitions are
+        self.assertEqual(self.swap_statements(self.alter(self.definition())), [
+            'DROP VIEW IF EXISTS example_models_pets_swap;',
+            'CREATE OR REPLACE VIEW example_models_pets_swap AS',
+            'DROP VIEW IF EXISTS example_models_pets;',
+            'ALTER VIEW example_models_pets_swap RENAME TO example_models_pets;'])
+        materialized = self.definition(materialized=True)
+        statements = self.swap_statements(self.alter(materialized, materialized=True, indexes=(('name',),)))
+        self.assertEqual(statements[:2], ['DROP MATERIALIZED VIEW IF EXISTS example_models_pets_swap;',
+                                          'CREATE MATERIALIZED VIEW example_models_pets_swap AS'])
+        self.assertIn('DROP MATERIALIZED VIEW IF EXISTS example_models_pets;', statements)
+        self.assertIn('ALTER INDEX example_models_pets_swap_name_idx RENAME TO example_models_pets_name_idx;',
+                      statements)
+        statements = self.swap_statements(self.alter(materialized, incremental=True))
+        self.assertIn('DROP MATERIALIZED VIEW IF EXISTS example_models_pets;', statements)
+        self.assertEqual(statements[statements.index('DROP MATERIALIZED VIEW IF EXISTS example_models_pets;') + 1],
+                         'ALTER TABLE example_models_pets_swap RENAME TO example_models_pets;')
+
+    @skipUnless(connection.vendor == 'postgresql', "Combined views are Postgres views")
+    def test_swap_applied(self):
+        state = ProjectState.from_apps(apps)
+        models.Cat.objects.create(name='Tom', breed='Tabby', coat_type='short')
+        models.Dog.objects.create(name='Rex', breed='Boxer', coat_description='wiry')
+        view = self.definition()
+        materialized = self.definition(materialized=True)
+        indexed = self.definition(materialized=True, indexes=(('name',),))
+        incremental = self.definition(incremental=True)
+        with connection.schema_editor() as schema_editor:
+            operations.CreateCombinedView('Pet', **view).database_forwards('example_models', schema_editor,
+                                                                          state, state)
+            for previous, options in ((view, view), (view, materialized), (materialized, indexed),
+                                      (indexed, incremental)):
+                operation = operations.AlterCombinedView('Pet', previous=previous, **options)
+                operation.database_forwards('example_models', schema_editor, state, state)
+                self.assertEqual(sorted(models.Pet.objects.values_list('name', flat=True)), ['Rex', 'Tom'])
+            operations.RemoveCombinedView('Pet', **incremental).database_forwards('example_models', schema_editor,
+                                                                                 state, state)
+
+    def lock_timeout(self):
+        error = operations.OperationalError('canceling statement due to lock timeout')
+        error.__cause__ = Exception()
+        error.__cause__.pgcode = operations.LOCK_NOT_AVAILABLE
+        return error
+
+    def swap(self, operation, outcomes):
+        state = ProjectState.from_apps(apps)
+        schema_editor = Mock(collect_sql=False, connection=connection)
+        with patch.object(operations.CombinedViewOperation, '_run_sql'), \
+             patch.object(operation, '_run_sql_with_lock_timeout', side_effect=outcomes) as swap, \
+             patch.object(operations.time, 'sleep') as sleep:
+            operation.database_forwards('example_models', schema_editor, state, state)
+        return swap.call_count, [ call[0][0] for call in sleep.call_args_list ]
+
+    def test_swap_retried_on_lock_timeout(self):
+        operation = self.alter(self.definition(), retries=3, retry_delay=0.5)
+        self.assertEqual(self.swap(operation, [self.lock_timeout(), self.lock_timeout(), None]), (3, [0.5, 1.0]))
+
+    def test_swap_gives_up(self):
+        operation = self.alter(self.definition(), retries=1)
+        with self.assertRaises(operations.OperationalError):
+            self.swap(operation, [self.lock_timeout(), self.lock_timeout()])
+        with self.assertRaises(operations.OperationalError):
+            self.swap(operation, [operations.OperationalError('other')])
+
+
 class TestMakeCombinedViewsCommand(TestCase):
 
+    def graph(self, *operations):
+        graph = MigrationGraph()
+        parent = None
+        for number, operation in enumerate(operations):
+            key = ('example_models', '{:04}'.format(number))
+            graph.add_node(key, Mock(operations=[operation]))
+            if parent is not None:
+                graph.add_dependency(None, key, parent)
+            parent = key
+        return graph
+
     def test_gather_combined_models(self):
-        pass
+        self.assertEqual(makecombinedviews.gather_combined_models(['example_models']),
+                         {('example_models', 'pet'): models.Pet, ('example_models', 'replyview'): models.ReplyView})
 
-    def test_handle_init(self):
-        pass
+    def test_view_fingerprint(self):
+        definition = makecombinedviews.view_definition(models.Pet)
+        renames = { newname: list(reversed(remap)) for newname, remap in definition['renames'].items() }
+        self.assertEqual(operations.view_fingerprint(definition['donors'], renames,
+                                                     makecombinedviews.model_columns(models.Pet), union_all=True),
+                         definition['fingerprint'])
+        self.assertNotEqual(operations.view_fingerprint(definition['donors'], renames, [], union_all=True),
+                            definition['fingerprint'])
 
-    def test_historical_combined_models(self):
-        pass
+    def test_alter_migrations_not_atomic(self):
+        migration = Migration('0002_combined_views', 'example_models')
+        migration.operations = [operations.AlterCombinedView('Pet', [], {})]
+        command = makecombinedviews.Command()
+        command._mcv_written = []
+        with patch.object(makecombinedviews.makemigrations.Command, 'write_migration_files'):
+            command.write_migration_files({'example_models': [migration]})
+        # the swap commits, and releases its locks, on its own
+        self.assertFalse(migration.atomic)
+        self.assertIn('(migrations.Migration):\n\n    atomic = False\n',
+                      makecombinedviews.NonAtomicMigrationWriter(migration).as_string())
 
-    def test_get_combined_model_additions_and_removals(self):
-        pass
+    def test_union_view_upgrade_warned(self):
+        current = makecombinedviews.view_definition(models.Pet)
+        graph = self.graph(operations.CreateCombinedView('Pet', **dict(current, union_all=False, fingerprint=None)),
+                           operations.CreateCombinedView('ReplyView', **makecombinedviews.view_definition(
+                               models.ReplyView)))
+        loader = Mock(graph=graph, project_state=Mock(return_value=Mock(models={})))
+        stderr = io.StringIO()
+        changes = makecombinedviews.Command(stderr=stderr)._mcv_view_operations(loader, ['example_models'])
+        alter, = changes['example_models']
+        self.assertTrue(alter.union_all)
+        self.assertIn('example_models.Pet is a UNION view', stderr.getvalue())
+
+    def test_latest_view_operations(self):
+        create = operations.CreateCombinedView('Pet', [], {})
+        alter = operations.AlterCombinedView('Pet', [], {})
+        remove = operations.RemoveCombinedView('Gone', [], {})
+        latest = makecombinedviews.latest_view_operations(
+            self.graph(create, operations.CreateCombinedView('Gone', [], {}), alter, remove))
+        self.assertEqual(latest, {('example_models', 'pet'): alter})
+
+    def test_view_operations(self):
+        current = makecombinedviews.view_definition(models.Pet)
+        old = dict(current, fingerprint=None, indexes=(('name',),))
+        graph = self.graph(operations.CreateCombinedView('Pet', **current),
+                           operations.CreateCombinedView('Gone', [], {}, fingerprint='f'))
+        loader = Mock(graph=graph, project_state=Mock(return_value=Mock(models={})))
+        changes = makecombinedviews.Command()._mcv_view_operations(loader, ['example_models'])
+        create, remove = changes['example_models']
+        self.assertIsInstance(create, operations.CreateCombinedView)
+        self.assertEqual(create.name, 'ReplyView')
+        self.assertIsInstance(remove, operations.RemoveCombinedView)
+        self.assertEqual(remove.db_table, 'example_models_gone')
+
+        graph = self.graph(operations.CreateCombinedView('Pet', **old))
+        loader = Mock(graph=graph, project_state=Mock(return_value=Mock(models={})))
+        alter = makecombinedviews.Command()._mcv_view_operations(loader, ['example_models'])['example_models'][0]
+        self.assertIsInstance(alter, operations.AlterCombinedView)
+        self.assertEqual(alter.previous['indexes'], (('name',),))
+
+
+    def test_depends_on_field(self):
+        pet = operations.CreateCombinedView('Pet', [('example_models', 'Cat')],
+                                            {'volume': [('example_models', 'cat', 'meow_volume')]})
+        state = Mock(models={('example_models', 'cat'): Mock(fields=[('id', Mock(primary_key=True)),
+                                                                     ('breed', Mock(primary_key=False))],
+                                                             bases=('example_models.animal',)),
+                             ('example_models', 'animal'): Mock(fields=[('legs', Mock(primary_key=False))], bases=()),
+                             ('example_models', 'pet'): Mock(fields=[('id', Mock()), ('name', Mock())])})
+        self.assertTrue(pet.depends_on_field('example_models', state, ('example_models', 'cat'), 'meow_volume'))
+        self.assertTrue(pet.depends_on_field('example_models', state, ('example_models', 'cat'), 'id'))
+        self.assertTrue(pet.depends_on_field('example_models', state, ('example_models', 'cat'), 'name'))
+        self.assertFalse(pet.depends_on_field('example_models', state, ('example_models', 'cat'), 'breed'))
+        self.assertFalse(pet.depends_on_field('example_models', state, ('example_models', 'dog'), 'name'))
+        pet.filters = [('example_models', 'cat', operations.deconstruct_q(Q(breed='tabby') | Q(legs=3)))]
+        self.assertTrue(pet.depends_on_field('example_models', state, ('example_models', 'cat'), 'breed'))
+        # fields the donor inherits from a parent
+        self.assertTrue(pet.depends_on_field('example_models', state, ('example_models', 'animal'), 'legs'))
+        self.assertTrue(pet.depends_on_field('example_models', state, ('example_models', 'animal'), 'name'))
+        self.assertFalse(pet.depends_on_field('example_models', state, ('example_models', 'animal'), 'tail'))
+
+    def test_filters_deconstructed(self):
+        q_object = Q(breed='tabby') | ~Q(meow_volume__gt=3, name__startswith='T')
+        deconstructed = operations.deconstruct_q(q_object)
+        self.assertEqual(str(operations.reconstruct_q(deconstructed)), str(q_object))
+        definition = makecombinedviews.view_definition(models.Pet)
+        self.assertEqual(definition.pop('filters'), [])
+        fingerprint = definition.pop('fingerprint')
+        columns = makecombinedviews.model_columns(models.Pet)
+        self.assertEqual(operations.view_fingerprint(columns=columns, **definition), fingerprint)
+        filters = [('example_models', 'cat', deconstructed)]
+        self.assertNotEqual(operations.view_fingerprint(columns=columns, filters=filters, **definition), fingerprint)
+
+    def test_bracket_donor_changes(self):
+        current = makecombinedviews.view_definition(models.Pet)
+        command = makecombinedviews.Command()
+        command._mcv_loader = Mock(graph=self.graph(operations.CreateCombinedView('Pet', **current)),
+                                   project_state=Mock(return_value=Mock(models={})))
+        add = AddField('cat', 'whiskers', TextField())
+        alter_cat = AlterField('cat', 'coat_type', TextField())
+        alter_dog = AlterField('dog', 'bark_volume', TextField())
+        remove = RemoveField('post', 'body')
+        migration = Migration('0002_auto', 'example_models')
+        migration.operations = [add, alter_cat, alter_dog, remove]
+        command._mcv_bracket_donor_changes({'example_models': [migration]})
+        drop, recreate = migration.operations[1], migration.operations[4]
+        self.assertEqual(migration.operations, [add, drop, alter_cat, alter_dog, recreate, remove])
+        self.assertIsInstance(drop, operations.DropCombinedViews)
+        self.assertEqual([ (app_label, view.name) for app_label, view in recreate.view_operations() ],
+                         [('example_models', 'Pet')])
+        # the recreated view counts as defined by the migration, so no AlterCombinedView follows
+        self.assertEqual(makecombinedviews.latest_view_operations(self.graph(recreate))[('example_models', 'pet')]
+                         .fingerprint, current['fingerprint'])
+
+        migration.operations = [add, remove]
+        command._mcv_bracket_donor_changes({'example_models': [migration]})
+        self.assertEqual(migration.operations, [add, remove])
 
 
 class TestViewTypeConstruction(TestCase):
@@ -244,10 +580,502 @@ class TestViewTypeConstruction(TestCase):
                     donors = ()
                     renames = {}
             self.assertTrue(hasattr(NewModelView, '_combiner'))
+            self.assertTrue(NewModelView._combiner.union_all)
+            self.assertIn(DISCRIMINATOR, model_base_new.call_args[0][3])
+
+    def test_combiner_without_union_all(self):
+        with patch.object(ModelBase, '__new__', return_value=Mock(name='FakeClass')) as model_base_new:
+            class NewModelView(CombinedModelView, Model):
+                field1 = TextField(primary_key=True)
+                class Combiner:
+                    donors = ()
+                    renames = {}
+                    union_all = False
+            self.assertFalse(NewModelView._combiner.union_all)
+            self.assertNotIn(DISCRIMINATOR, model_base_new.call_args[0][3])
 
 
     def test_illegal_configurations(self):
-        pass
+        with self.assertRaises(ImproperlyConfigured):
+            CombineOptions((), {}, materialized=True, incremental=True)
+
+
+class TestCombinedQuery(TestCase):
+
+    def where_sql(self, queryset):
+        sql = str(queryset.query)
+        return sql[sql.index(' WHERE '):]
+
+    def test_split_id(self):
+        self.assertEqual(models.Pet._combiner.split_id('example_models_dog.12'), (1, 12))
+        self.assertIsNone(models.Pet._combiner.split_id('example_models_cow.12'))
+        self.assertIsNone(models.Pet._combiner.split_id('example_models_dog.twelve'))
+
+    def test_pk_lookup_rewritten(self):
+        where = self.where_sql(models.Pet.objects.filter(pk='example_models_cat.5'))
+        self.assertIn('"donor" = 0', where)
+        self.assertIn('"donor_pk" = 5', where)
+        self.assertNotIn('"id"', where)
+
+    def test_pk_in_lookup_grouped_by_donor(self):
+        where = self.where_sql(models.Pet.objects.filter(id__in=['example_models_cat.5', 'example_models_dog.6',
+                                                                  'example_models_dog.7', 'nonsense']))
+        self.assertIn('"donor" = 0', where)
+        self.assertIn('"donor_pk" = 5', where)
+        self.assertIn('"donor" = 1', where)
+        self.assertIn('"donor_pk" IN (6, 7)', where)
+        self.assertIn('"id" IN (nonsense)', where)
+
+    def test_donor_pruning(self):
+        sql = str(models.Pet.objects.filter(donor=1).query)
+        self.assertIn('FROM example_models_dog', sql)
+        self.assertNotIn('example_models_cat', sql)
+        sql = str(models.Pet.objects.filter(pk__in=['example_models_cat.5', 'example_models_dog.6']).query)
+        self.assertNotIn('FROM (', sql)
+        sql = str(models.Pet.objects.filter(donor=1).exclude(donor=0).filter(Q(donor=1) | Q(name='Rex')).query)
+        self.assertIn('FROM (', sql)
+        self.assertIn('FROM example_models_dog', sql)
+        self.assertEqual(models.Pet.objects.filter(pk='example_models_cat.5').query.donor_positions, {0})
+        self.assertEqual(models.Pet.objects.filter(donor=1).filter(donor=0).query.donor_positions, frozenset())
+        # no donor is at position 5, so no rows can match, and no query runs
+        self.assertEqual(models.Pet.objects.filter(donor__in=[0, 5]).query.donor_positions, {0})
+        self.assertEqual(models.Pet.objects.filter(donor__in=[5]).query.donor_positions, frozenset())
+        self.assertEqual(models.Pet.objects.filter(donor__in=[5]).count(), 0)
+        self.assertEqual(list(models.Pet.objects.filter(donor=-1)), [])
+
+    def test_combiner_filters(self):
+        combiner = models.Pet._combiner
+        plan = sqlfuncs.selection_plan(models.Pet, combiner.donor_models, combiner.renames.as_dict(), union_all=True,
+                                       filters={models.Dog: Q(bark_volume__gt=2) | Q(name__contains='x')})
+        self.assertIsNone(plan.branches[0].where)
+        # the lookups are rendered by the connection's backend, values and all
+        where = plan.branches[1].where
+        self.assertTrue(where.startswith('("example_models_dog"."bark_volume" > 2 OR "example_models_dog"."name"'))
+        self.assertIn("'%x%'", where)
+        self.assertEqual(sqlfuncs.render_selection(plan).count('\n         WHERE ("example_models_dog"'), 1)
+        sql, params = sqlfuncs.query_selection_sql(plan, branch_where=lambda position: ('donor_pk = %s', [7]))
+        self.assertIn("LIKE '%%x%%'", sql)
+        self.assertIn(' AND (donor_pk = %s)', sql)
+        self.assertEqual(params, [7, 7])
+        with self.assertRaises(ValueError):
+            sqlfuncs.filter_sql(models.React, Q(user__username='rex'))
+        where, _ = sqlfuncs.filter_sql(models.Dog, Q(name='日本'))
+        self.assertIn("'日本'", where)
+        with self.assertRaises(ImproperlyConfigured):
+            CombineOptions([models.Cat], {}, incremental=True, filters={models.Cat: Q(breed='tabby')})
+        with self.assertRaises(ImproperlyConfigured):
+            CombineOptions([models.Cat], {}, filters={models.Dog: Q(breed='boxer')})
+
+    def test_inherited_columns(self):
+        combiner = models.ReplyView._combiner
+        comment, react = combiner.plan.branches
+        self.assertEqual(comment.joins, (sqlfuncs.Join('example_models_replyable', 'useractivity_ptr_id',
+                                                       'example_models_comment', 'replyable_ptr_id'),))
+        self.assertEqual(combiner.source_column(0, 'content'), 'example_models_replyable.content')
+        self.assertEqual(react.joins, ())
+        self.assertEqual([ donor_field.name for _, donor_field in combiner.donor_fields(0) ],
+                         ['in_response_to', 'content'])
+        sql = sqlfuncs.render_selection(combiner.plan)
+        self.assertIn('example_models_comment.replyable_ptr_id AS donor_pk', sql)
+        self.assertIn('LEFT JOIN example_models_replyable ON example_models_replyable.useractivity_ptr_id = '
+                      'example_models_comment.replyable_ptr_id', sql)
+        # the grandparent is joined on the donor's pk, without the parent in between
+        plan = sqlfuncs.selection_plan(models.ReplyView, combiner.donor_models, combiner.renames.as_dict(),
+                                       union_all=True, filters={models.Comment: Q(time_posted__isnull=False)})
+        self.assertEqual(plan.branches[0].joins[1], sqlfuncs.Join('example_models_useractivity', 'id',
+                                                                  'example_models_comment', 'replyable_ptr_id'))
+        with self.assertRaises(ValueError):
+            sqlfuncs.sync_trigger_sql(models.ReplyView, comment)
+
+    def test_foreign_key_pushdown(self):
+        replyable = models.Replyable(pk=5)
+        sql = str(replyable.replyview_set.all().query)
+        self.assertEqual(sql.count('WHERE (in_response_to_id IN (5)))'), 2)
+        fetched = []
+        with patch.object(query.CombinedQuerySet, '_fetch_all', autospec=True,
+                          side_effect=lambda qs: (fetched.append(qs), setattr(qs, '_result_cache', []))):
+            replyable.replyview_set.get_prefetch_queryset([replyable, models.Replyable(pk=7)])
+        self.assertEqual(str(fetched[0].query).count('WHERE (in_response_to_id IN (5, 7)))'), 2)
+        conditions = models.ReplyView.objects.filter(in_response_to__pk__in=['3', 4]).query.branch_conditions
+        self.assertEqual(conditions[0].values, [3, 4])
+        for queryset in (models.ReplyView.objects.exclude(in_response_to=3),
+                         models.ReplyView.objects.filter(Q(in_response_to=3) | Q(content='x')),
+                         models.ReplyView.objects.filter(in_response_to__in=models.Replyable.objects.all()),
+                         models.ReplyView.objects.filter(in_response_to=None)):
+            self.assertEqual(queryset.query.branch_conditions, ())
+
+    def test_combiner_plan(self):
+        combiner = models.Pet._combiner
+        self.assertIs(combiner.plan, combiner.plan)
+        self.assertEqual(combiner.source_column(1, 'volume'), 'bark_volume')
+        self.assertIsNone(combiner.source_column(1, 'id'))
+        self.assertEqual(combiner.renames.new_name(models.Dog, 'bark_volume'), 'volume')
+
+    def test_keyset_condition(self):
+        combiner = models.Pet._combiner
+        field = models.Pet._meta.get_field('volume')
+        condition = query.KeysetCondition(field, False, (4, 0, 17))
+        self.assertEqual(condition.as_sql(combiner, 0), ('(meow_volume, id) > (%s, %s)', [4, 17]))
+        self.assertEqual(condition.as_sql(combiner, 1), ('bark_volume >= %s', [4]))
+        condition = query.KeysetCondition(field, True, (4, 1, 17))
+        self.assertEqual(condition.as_sql(combiner, 0), ('meow_volume <= %s', [4]))
+        self.assertEqual(condition.as_sql(combiner, 1), ('(bark_volume, id) < (%s, %s)', [4, 17]))
+        self.assertEqual(query.KeysetCondition(field, True).as_sql(combiner, 0), ('meow_volume IS NOT NULL', []))
+
+    def test_keyset_cursor(self):
+        field = models.Pet._meta.get_field('volume')
+        cursor = query.encode_cursor(4, 1, 17)
+        self.assertEqual(query.decode_cursor(cursor, field), (4, 1, 17))
+        with self.assertRaises(ValueError):
+            query.decode_cursor('garbage', field)
+
+    def test_keyset_page_pushdown(self):
+        queryset = models.Pet.objects.all()
+        with patch.object(query.CombinedQuerySet, '_fetch_all', autospec=True,
+                          side_effect=lambda qs: setattr(qs, '_result_cache', [qs])):
+            rows, cursor = queryset.keyset_page('-volume', cursor=query.encode_cursor(4, 1, 17), page_size=2)
+        self.assertIsNone(cursor)
+        sql, params = rows[0].query.sql_with_params()
+        self.assertIn('(bark_volume, id) < (%s, %s)', sql)
+        self.assertIn('ORDER BY volume DESC, donor_pk DESC', sql)
+        self.assertIn('LIMIT 2', sql)
+        self.assertEqual(params[:3], (4, 4, 17))
+
+    def test_top_n_pushdown(self):
+        sql = str(models.Pet.objects.order_by('-volume', 'pk')[5:10].query)
+        self.assertEqual(sql.count('ORDER BY volume DESC, id\n         LIMIT 10)'), 2)
+        self.assertIn('LIMIT 5 OFFSET 5', sql)
+        self.assertIn('LIMIT 1)', str(models.Pet.objects.all()[:1].query))
+        for queryset in (models.Pet.objects.order_by('-volume'), models.Pet.objects.filter(name='Rex')[:10],
+                         models.Pet.objects.order_by('?')[:10], models.Pet.objects.distinct()[:10]):
+            self.assertNotIn('FROM (', str(queryset.query))
+
+    def test_projection_pushdown(self):
+        sql = str(models.Pet.objects.filter(volume__gt=3).values('name').query)
+        self.assertEqual(sql.count('name,\n         bark_volume AS volume\n'), 1)
+        self.assertNotIn('coat', sql)
+        self.assertNotIn('breed', sql)
+        sql = str(models.Pet.objects.only('breed').order_by('name').query)
+        self.assertNotIn('coat', sql)
+        self.assertIn('AS id,\n         name,\n         breed\n', sql)
+        for queryset in (models.Pet.objects.all(), models.Pet.objects.extra(where=['coat > 1']).values('name'),
+                         models.Pet.objects.filter(name__in=models.Pet.objects.values('breed')).values('id')):
+            self.assertNotIn('coat_type', str(queryset.query).split(' WHERE ')[0])
+
+    def test_fetching_in_chunks(self):
+        cursor = Mock(fetchmany=Mock(side_effect=[[(1, 'a', 'x'), (2, 'b', 'x')], [(3, 'c', 'x')], []]))
+        compiler = Mock(execute_sql=Mock(return_value=cursor), col_count=2)
+        execute_sql = query.fetching_in_chunks(compiler, 2)
+        self.assertEqual(list(execute_sql(chunked_fetch=True)), [[(1, 'a'), (2, 'b')], [(3, 'c')]])
+        compiler.execute_sql.assert_called_once_with(query.CURSOR, chunked_fetch=True)
+        cursor.fetchmany.assert_called_with(2)
+        cursor.close.assert_called_once_with()
+        self.assertEqual(models.Pet.objects.all().query.get_compiler('default').execute_sql.__name__, 'execute_sql')
+
+    def test_aggregate_pushdown(self):
+        values = {0: (3, 1, 8, 4, 4, 3), 1: (5, None, 12, 6, 6, 5)}
+        partials = { position: { 'partial_{}'.format(i): value for i, value in enumerate(values[position]) }
+                     for position in values }
+        queries = []
+
+        def get_aggregation(aggregate_query, using, names):
+            queries.append(str(aggregate_query))
+            position, = aggregate_query.donor_positions
+            return { name: partials[position][name] for name in names }
+        with patch.object(query.CombinedQuery, 'get_aggregation', autospec=True, side_effect=get_aggregation):
+            result = models.Pet.objects.aggregate(Count('id'), low=Min('volume'), high=Max('volume'),
+                                                  total=Sum('volume'), mean=Avg('volume'))
+        self.assertEqual(result, {'id__count': 8, 'low': 1, 'high': 12, 'total': 10, 'mean': 1.25})
+        self.assertEqual(len(queries), 2)
+        self.assertIn('FROM example_models_cat', queries[0])
+        self.assertNotIn('example_models_dog', queries[0])
+
+    def test_aggregate_split(self):
+        queryset = models.Pet.objects.all()
+        split = queryset._split_aggregates(queryset.annotate(mean=Avg('volume'), n=Count('*')).query.annotations)
+        partials, combiners = split
+        self.assertEqual(list(combiners), ['mean', 'n'])
+        self.assertEqual(combiners['mean'][0]([(10, 4), (None, 0), (5, 1)]), 3.0)
+        self.assertEqual(combiners['n'][0]([(3,), (None,)]), 3)
+        distinct = queryset.annotate(n=Count('name', distinct=True))
+        self.assertIsNone(queryset._split_aggregates(distinct.query.annotations))
+        self.assertFalse(queryset.filter(donor=1).values('breed').annotate(n=Count('id'))._groups_by_donor())
+        self.assertFalse(queryset.values('breed').annotate(n=Count('id')).filter(n__gt=1)._groups_by_donor())
+        # mins, maxes and orderings of text would be compared in Python, not by the database's collation
+        self.assertIsNone(queryset._split_aggregates(queryset.annotate(first=Min('name')).query.annotations))
+        self.assertIsNotNone(queryset._split_aggregates(queryset.annotate(n=Count('name')).query.annotations))
+        self.assertFalse(queryset.values('breed').annotate(n=Count('id')).order_by('breed')._groups_by_donor())
+
+    def test_grouped_aggregate_pushdown(self):
+        queryset = models.Pet.objects.values('breed').annotate(n=Count('id'), loudest=Max('volume')).order_by('-n')
+        self.assertTrue(queryset._groups_by_donor())
+        rows = {0: [ {'breed': breed, 'partial_0': n, 'partial_1': loudest} for breed, n, loudest in
+                     (('Tabby', 2, 3), (None, 1, 2)) ],
+                1: [ {'breed': breed, 'partial_0': n, 'partial_1': loudest} for breed, n, loudest in
+                     (('Tabby', 1, 9), ('Boxer', 4, 6)) ]}
+        queries = []
+
+        def values(iterable):
+            queries.append(str(iterable.queryset.query))
+            position, = iterable.queryset.query.donor_positions
+            return iter(rows[position])
+        with patch.object(ValuesIterable, '__iter__', autospec=True, side_effect=values):
+            results = list(queryset)
+        self.assertEqual(results, [{'breed': 'Boxer', 'n': 4, 'loudest': 6},
+                                   {'breed': 'Tabby', 'n': 3, 'loudest': 9},
+                                   {'breed': None, 'n': 1, 'loudest': 2}])
+        self.assertIn('GROUP BY "example_models_pets"."breed"', queries[0])
+        self.assertNotIn('ORDER BY', queries[0])
+
+    def test_count_by_donor(self):
+        counts = {0: 3, 1: 5}
+        get_count = lambda count_query, using: counts[next(iter(count_query.donor_positions))]
+        with patch.object(query.CombinedQuery, 'get_count', autospec=True, side_effect=get_count):
+            self.assertEqual(models.Pet.objects.count_by_donor(parallel=False), {models.Cat: 3, models.Dog: 5})
+            self.assertEqual(models.Pet.objects.filter(donor=1).count_by_donor(parallel=False),
+                             {models.Cat: 0, models.Dog: 5})
+            self.assertEqual(models.Pet.objects.count_fast(parallel=False), 8)
+
+    def test_estimated_count(self):
+        with patch.object(query, 'estimated_rows', return_value={'example_models_cat': 40}) as estimated_rows:
+            self.assertEqual(models.Pet.objects.estimated_count(), 40)
+            self.assertEqual(models.Pet.objects.filter(donor=0).estimated_count(by_donor=True),
+                             {models.Cat: 40, models.Dog: 0})
+        self.assertEqual(estimated_rows.call_args_list[0][0], (['example_models_cat', 'example_models_dog'], 'default'))
+        self.assertEqual(estimated_rows.call_args_list[1][0], (['example_models_cat'], 'default'))
+
+    def test_copy_to(self):
+        self.assertEqual(sqlfuncs.copy_sql('SELECT 1', 'csv', header=True),
+                         "COPY (SELECT 1) TO STDOUT WITH (FORMAT csv, HEADER)")
+        with self.assertRaises(ValueError):
+            models.Pet.objects.copy_to(io.BytesIO(), format='json')
+
+        def spooled(data):
+            # as copy_to() spools each donor's output
+            spool = SpooledTemporaryFile(mode='w+b')
+            spool.write(data)
+            return spool
+
+        spools = [ spooled(b'name,volume\nTom,3\n'), spooled(b'Rex,7\n') ]
+        output = io.StringIO()
+        query.concatenate_copies(spools, output)
+        self.assertEqual(output.getvalue(), 'name,volume\nTom,3\nRex,7\n')
+
+        header, trailer = b'PGCOPY\n\xff\r\n\x00' + bytes(8), b'\xff\xff'
+        spools = [ spooled(header + b'cat rows' + trailer), spooled(header + b'dog rows' + trailer) ]
+        output = io.BytesIO()
+        query.concatenate_copies(spools, output, binary=True)
+        self.assertEqual(output.getvalue(), header + b'cat rowsdog rows' + trailer)
+
+    def test_copy_from_splits_by_donor(self):
+        self.assertEqual(sqlfuncs.copy_from_sql('cat', ['name', 'breed'], 'csv', not_null=['name']),
+                         "COPY cat (name, breed) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (name))")
+        csv_input = io.StringIO('id,donor,name,volume,coat\n'
+                                'x,0,Tom,3,short\n'
+                                'x,1,"Rex, Jr.",7,\n'
+                                'x,0,Kit,,long\n')
+        spools, sqls = models.Pet.objects.all()._spool_by_donor(csv_input, 'csv', True, None)
+        # the input has no breed, and Dog.wags_per_second has no view field, so they get their defaults
+        self.assertEqual([ spool.seek(0) or spool.read() for spool in spools.values() ],
+                         ['Tom,3,short,\r\nKit,,long,\r\n', '"Rex, Jr.",7,,,3.0\r\n'])
+        self.assertEqual(sqls[1], "COPY example_models_dog (name, bark_volume, coat_description, breed, "
+                                  "wags_per_second) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (name, bark_volume, "
+                                  "coat_description, breed, wags_per_second))")
+
+        text_input = io.BytesIO(b'1\tRex\t\\N\n0\tTom\t\\N\n\\.\n')
+        spools, sqls = models.Pet.objects.all()._spool_by_donor(text_input, 'text', False, ['donor', 'name', 'volume'])
+        self.assertEqual([ spool.seek(0) or spool.read() for spool in spools.values() ],
+                         ['Rex\t\\N\t\t\t3.0\n', 'Tom\t\\N\t\t\n'])
+        self.assertEqual(list(spools), [1, 0])
+
+        field = lambda data: struct.pack('>i', len(data)) + data
+        binary_input = io.BytesIO(query.BINARY_COPY_SIGNATURE + bytes(8) +
+                                  struct.pack('>h', 3) + field(struct.pack('>h', 1)) + field(b'Rex') + field(b'') +
+                                  struct.pack('>h', -1))
+        spools, sqls = models.Pet.objects.all()._spool_by_donor(binary_input, 'binary', False,
+                                                                ['donor', 'name', 'breed'])
+        self.assertEqual(spools[1].seek(0) or spools[1].read(), query.BINARY_COPY_SIGNATURE + bytes(8) +
+                         struct.pack('>h', 5) + field(b'Rex') + field(b'') + field(struct.pack('>h', models.LOUD)) +
+                         field(b'') + field(struct.pack('>d', 3.0)) + struct.pack('>h', -1))
+        self.assertEqual(sqls[1], "COPY example_models_dog (name, breed, bark_volume, coat_description, "
+                                  "wags_per_second) FROM STDIN WITH (FORMAT binary)")
+        field_default = query.copy_default(TextField(default='a\tb\\'), 'text', connection)
+        self.assertEqual(field_default(), 'a\\tb\\\\')
+        # without a default, nothing can fill the NOT NULL column, and the dogs can't be loaded
+        with patch.multiple(models.Dog._meta.get_field('wags_per_second'), has_default=Mock(return_value=False),
+                            get_default=Mock(return_value=None)), \
+                self.assertRaisesRegex(ValueError, 'Row 1 .*wags_per_second has no default'):
+            models.Pet.objects.all()._spool_by_donor(io.StringIO('1,Rex\n'), 'csv', False, ['donor', 'name'])
+
+        with self.assertRaises(ValueError):
+            models.Pet.objects.all()._spool_by_donor(io.StringIO('Tom\n'), 'csv', False, ['name'])
+        # rows with a NULL or non-integer discriminator have no donor, not the first one
+        null_input = io.BytesIO(query.BINARY_COPY_SIGNATURE + bytes(8) +
+                                struct.pack('>h', 2) + query.BINARY_COPY_NULL + field(b'Rex') + struct.pack('>h', -1))
+        with self.assertRaisesRegex(ValueError, 'Row 1 '):
+            models.Pet.objects.all()._spool_by_donor(null_input, 'binary', False, ['donor', 'name'])
+        with self.assertRaisesRegex(ValueError, 'Row 2 '):
+            models.Pet.objects.all()._spool_by_donor(io.StringIO('0,Tom\n,Rex\n'), 'csv', False, ['donor', 'name'])
+        # Comment's content is a column of its parent, Replyable
+        with self.assertRaises(TypeError):
+            models.ReplyView.objects.all()._spool_by_donor(io.StringIO('0,Hi\n'), 'csv', False, ['donor', 'content'])
+
+    def test_other_lookups_untouched(self):
+        queryset = models.Pet.objects.filter(pk__startswith='example_models_cat.')
+        self.assertEqual(queryset.query._rewrite_pk_lookup('pk__startswith', 'example_models_cat.'),
+                         ('pk__startswith', 'example_models_cat.'))
+        # the lookup stays on the id, however the backend spells it, and isn't pushed into the branches
+        where = self.where_sql(queryset)
+        self.assertIn('"id"', where)
+        self.assertNotIn('"donor', where)
+        self.assertEqual(queryset.query.branch_conditions, ())
+        self.assertIsNone(queryset.query.donor_positions)
+
+
+class TestParallel(TestCase):
+
+    def test_parallel_streams(self):
+        streams = parallel.parallel_streams([lambda: range(0, 10, 2), lambda: range(1, 10, 2), lambda: []],
+                                            'default', chunk_size=3, buffered_chunks=1)
+        self.assertEqual([list(stream) for stream in streams], [[0, 2, 4, 6, 8], [1, 3, 5, 7, 9], []])
+
+    def test_parallel_streams_reraise(self):
+        def failing():
+            yield 1
+            raise ValueError('boom')
+        stream, = parallel.parallel_streams([failing], 'default', chunk_size=1)
+        with self.assertRaises(ValueError):
+            list(stream)
+
+    def test_parallel_map(self):
+        self.assertEqual(parallel.parallel_map(lambda x: x * 2, [1, 2, 3], 'default'), [2, 4, 6])
+
+    def test_fan_out_merge_key(self):
+        pets = [models.Pet(id='example_models_cat.1', donor=0, volume=2),
+                models.Pet(id='example_models_dog.1', donor=1, volume=None),
+                models.Pet(id='example_models_dog.2', donor=1, volume=6)]
+        merge_key = models.Pet.objects.order_by('-volume', 'donor')._merge_key()
+        self.assertEqual([pet.pk for pet in sorted(pets, key=merge_key)],
+                         ['example_models_dog.1', 'example_models_dog.2', 'example_models_cat.1'])
+        merge_key = models.Pet.objects.values_list('name', 'volume').order_by('volume')._merge_key()
+        self.assertEqual(sorted([('a', None), ('b', 6), ('c', 2)], key=merge_key), [('c', 2), ('b', 6), ('a', None)])
+        self.assertIsNone(models.Pet.objects.all()._merge_key())
+        with self.assertRaises(ValueError):
+            models.Pet.objects.values('name').order_by('volume')._merge_key()
+        # Postgres orders text by its collation, which Python can't reproduce
+        for ordering in ('name', '-pk'):
+            with self.assertRaises(ValueError):
+                models.Pet.objects.order_by('volume', ordering)._merge_key()
+
+
+class TestResolveDonors(DjTestCase):
+    def test_resolve_donors(self):
+        cat = models.Cat.objects.create(name='Tom', breed='Tabby', coat_type='short')
+        dog = models.Dog.objects.create(name='Rex', breed='Boxer', coat_description='short')
+        ids = [ 'example_models_dog.{}'.format(dog.pk), 'example_models_cat.{}'.format(cat.pk),
+                'example_models_cat.{}'.format(cat.pk + 1), 'nonsense' ]
+        rows = [ models.Pet(id=view_id) for view_id in ids ]
+        with self.assertNumQueries(2):
+            query.resolve_donors(rows, 'default')
+        self.assertEqual([ row.donor_object for row in rows ], [dog, cat, None, None])
+
+    def test_prefetch_donors_is_kept_by_clones(self):
+        queryset = models.Pet.objects.prefetch_donors(parallel=True).filter(name='Rex').order_by('name')
+        self.assertIs(queryset._donor_prefetch, True)
+        self.assertIsNone(models.Pet.objects.all()._donor_prefetch)
+        with self.assertRaises(TypeError):
+            models.Pet.objects.values('name').resolve_donors()
+
+
+class TestWritesThroughView(DjTestCase):
+
+    def test_bulk_create(self):
+        rows = [ models.Pet(donor=0, name='Tom', volume=3, breed='Tabby', coat='short'),
+                 models.Pet(donor=1, name='Rex', volume=7, breed='Boxer', coat='wiry'),
+                 models.Pet(donor=0, name='Kit', volume=1, breed='Manx', coat='long') ]
+        with self.assertNumQueries(2):
+            self.assertIs(models.Pet.objects.bulk_create(rows), rows)
+        self.assertEqual(list(models.Cat.objects.order_by('name').values_list('name', 'meow_volume', 'coat_type')),
+                         [('Kit', 1, 'long'), ('Tom', 3, 'short')])
+        self.assertEqual(list(models.Dog.objects.values_list('name', 'bark_volume', 'coat_description')),
+                         [('Rex', 7, 'wiry')])
+        with self.assertRaises(ValueError):
+            models.Pet.objects.bulk_create([models.Pet(name='Nobody')])
+        # Comment inherits from Replyable, so its rows span two tables; nothing is written
+        with self.assertRaises(TypeError), self.assertNumQueries(0):
+            models.ReplyView.objects.bulk_create([models.ReplyView(donor=0, content='Hi')])
+
+    def test_update_and_delete(self):
+        cat = models.Cat.objects.create(name='Tom', breed='Tabby', coat_type='short')
+        dog = models.Dog.objects.create(name='Rex', breed='Boxer', coat_description='wiry')
+        # as the view's subqueries would select them
+        donor_querysets = [(0, models.Cat.objects.all()), (1, models.Dog.objects.all())]
+        with patch.object(query.CombinedQuerySet, '_donor_querysets', return_value=iter(donor_querysets)):
+            self.assertEqual(models.Pet.objects.update(coat='matted', volume=9), 2)
+        cat.refresh_from_db()
+        dog.refresh_from_db()
+        self.assertEqual((cat.coat_type, cat.meow_volume, dog.coat_description, dog.bark_volume),
+                         ('matted', 9, 'matted', 9))
+        with patch.object(query.CombinedQuerySet, '_donor_querysets', return_value=iter(donor_querysets)):
+            self.assertEqual(models.Pet.objects.update(volume=F('volume') * 2 + 1), 2)
+        cat.refresh_from_db()
+        dog.refresh_from_db()
+        self.assertEqual((cat.meow_volume, dog.bark_volume), (19, 19))
+        with patch.object(query.CombinedQuerySet, '_donor_querysets', return_value=iter(donor_querysets)):
+            self.assertEqual(models.Pet.objects.delete(),
+                             (2, {'example_models.Cat': 1, 'example_models.Dog': 1}))
+
+    def test_donor_querysets(self):
+        cats = dict(models.Pet.objects.filter(name='Tom', donor=0)._donor_querysets())[0]
+        # the view's rows come from a subquery, which itself only reads from cats
+        self.assertIn('"example_models_cat"."id" IN (SELECT U0."donor_pk"', str(cats.query))
+        self.assertNotIn('example_models_dog', str(cats.query))
+
+
+class TestResultCache(TransactionTestCase):
+    # on_commit() callbacks, which keep results, only run outside of a test transaction
+
+    def test_donor_changes_invalidate(self):
+        result_cache = cache.ResultCache()
+        result_cache.watch(models.Pet)
+        queryset = models.Pet.objects.filter(name='Tom')._clone(_view_cache=result_cache)
+        rows = [ models.Pet(id='example_models_cat.1', name='Tom') ]
+        with patch.object(query.CombinedQuerySet, '_fetch_results', return_value=rows) as fetch:
+            self.assertEqual(list(queryset.all()), rows)
+            self.assertEqual(list(queryset.all()), rows)
+            self.assertEqual(fetch.call_count, 1)
+            self.assertIsNone(queryset.uncached()._view_cache)
+
+            models.Cat.objects.create(name='Tom', breed='Tabby', coat_type='short')
+            list(queryset.all())
+            self.assertEqual(fetch.call_count, 2)
+            # rows that can only come from dogs don't change with cats
+            dogs = queryset.filter(donor=1)
+            list(dogs.all())
+            models.Cat.objects.create(name='Tom', breed='Tabby', coat_type='long')
+            list(dogs.all())
+            self.assertEqual(fetch.call_count, 3)
+            cache.invalidate(models.Dog)
+            list(dogs.all())
+            self.assertEqual(fetch.call_count, 4)
+
+    def test_inherited_donor_tables(self):
+        result_cache = cache.ResultCache()
+        result_cache.watch(models.ReplyView)
+        queryset = models.ReplyView.objects.filter(donor=0)._clone(_view_cache=result_cache)
+        key = result_cache.key(queryset)
+        # Comment's content is read from its parent's table
+        cache.invalidate(models.Replyable)
+        self.assertNotEqual(result_cache.key(queryset), key)
+
+    def test_invalidate_on_commit(self):
+        result_cache = cache.ResultCache()
+        result_cache.watch(models.Pet)
+        with transaction.atomic():
+            cache.invalidate(models.Dog)
+            # what another connection reads now, before the commit, must not outlive it
+            version = result_cache.versions(['example_models_dog'])
+        self.assertNotEqual(result_cache.versions(['example_models_dog']), version)
 
 
 class AppWorksTestCase(DjTestCase):